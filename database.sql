@@ -3,8 +3,11 @@ CREATE TABLE IF NOT EXISTS genres (
     name VARCHAR(255) UNIQUE NOT NULL
 );
 
+-- Artists, albums and tracks are referenced by their integer surrogate key
+-- (sk), which is much smaller than the 22 characters Spotify id (id).
 CREATE TABLE IF NOT EXISTS artists (
-    id VARCHAR(255) PRIMARY KEY,
+    sk SERIAL PRIMARY KEY,
+    id VARCHAR(255) UNIQUE NOT NULL,
     name VARCHAR(255) NOT NULL,
     popularity INTEGER,
     followers INTEGER,
@@ -14,7 +17,8 @@ CREATE TABLE IF NOT EXISTS artists (
 );
 
 CREATE TABLE IF NOT EXISTS albums (
-    id VARCHAR(255) PRIMARY KEY,
+    sk SERIAL PRIMARY KEY,
+    id VARCHAR(255) UNIQUE NOT NULL,
     name VARCHAR(255) NOT NULL,
     label VARCHAR(255),
     popularity INTEGER,
@@ -27,7 +31,8 @@ CREATE TABLE IF NOT EXISTS albums (
 );
 
 CREATE TABLE IF NOT EXISTS tracks (
-    id VARCHAR(255) PRIMARY KEY,
+    sk SERIAL PRIMARY KEY,
+    id VARCHAR(255) UNIQUE NOT NULL,
     name VARCHAR(255) NOT NULL,
     disc_number INTEGER,
     duration INTEGER,
@@ -42,35 +47,116 @@ CREATE TABLE IF NOT EXISTS tracks (
 CREATE TABLE IF NOT EXISTS streaming_history (
     played_at TIMESTAMP WITHOUT TIME ZONE NOT NULL,
     ms_played INTEGER,
-    track_id VARCHAR(255) NOT NULL REFERENCES tracks(id),
+    track_sk INTEGER NOT NULL REFERENCES tracks(sk),
     context TEXT,
     reason_start TEXT,
     reason_end TEXT,
     skipped BOOLEAN,
     shuffle BOOLEAN,
-    PRIMARY KEY (played_at, track_id)
+    PRIMARY KEY (played_at, track_sk)
 );
 
 CREATE TABLE IF NOT EXISTS album_artists (
-    album_id VARCHAR(255) REFERENCES albums(id),
-    artist_id VARCHAR(255) REFERENCES artists(id),
-    PRIMARY KEY (album_id, artist_id)
+    album_sk INTEGER REFERENCES albums(sk),
+    artist_sk INTEGER REFERENCES artists(sk),
+    PRIMARY KEY (album_sk, artist_sk)
 );
 
 CREATE TABLE IF NOT EXISTS track_artists (
-    track_id VARCHAR(255) REFERENCES tracks(id),
-    artist_id VARCHAR(255) REFERENCES artists(id),
-    PRIMARY KEY (track_id, artist_id)
+    track_sk INTEGER REFERENCES tracks(sk),
+    artist_sk INTEGER REFERENCES artists(sk),
+    PRIMARY KEY (track_sk, artist_sk)
 );
 
 CREATE TABLE IF NOT EXISTS album_genres (
-    album_id VARCHAR(255) REFERENCES albums(id),
+    album_sk INTEGER REFERENCES albums(sk),
     genre_id INT REFERENCES genres(id),
-    PRIMARY KEY (album_id, genre_id)
+    PRIMARY KEY (album_sk, genre_id)
 );
 
 CREATE TABLE IF NOT EXISTS artist_genres (
-    artist_id VARCHAR(255) REFERENCES artists(id),
+    artist_sk INTEGER REFERENCES artists(sk),
     genre_id INT REFERENCES genres(id),
-    PRIMARY KEY (artist_id, genre_id)
+    PRIMARY KEY (artist_sk, genre_id)
+);
+
+CREATE TABLE IF NOT EXISTS failed_streaming_history (
+    played_at TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+    ms_played INTEGER,
+    track_id VARCHAR(255) NOT NULL,
+    context TEXT,
+    reason_start TEXT,
+    reason_end TEXT,
+    skipped BOOLEAN,
+    shuffle BOOLEAN,
+    failure_reason TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    status VARCHAR(16) NOT NULL DEFAULT 'pending',
+    last_attempt_at TIMESTAMP WITHOUT TIME ZONE,
+    next_attempt_at TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+    PRIMARY KEY (played_at, track_id)
+);
+
+CREATE TABLE IF NOT EXISTS imported_files (
+    content_hash VARCHAR(64) PRIMARY KEY,
+    filename TEXT NOT NULL,
+    size BIGINT NOT NULL,
+    mtime DOUBLE PRECISION NOT NULL,
+    row_count INTEGER,
+    imported_at TIMESTAMP WITHOUT TIME ZONE NOT NULL
+);
+
+-- Other names, sizes or modification times under which the content of an
+-- imported file was seen, e.g. copies, so they are skipped without hashing.
+CREATE TABLE IF NOT EXISTS imported_file_aliases (
+    filename TEXT NOT NULL,
+    size BIGINT NOT NULL,
+    mtime DOUBLE PRECISION NOT NULL,
+    content_hash VARCHAR(64) NOT NULL REFERENCES imported_files(content_hash),
+    PRIMARY KEY (filename, size, mtime)
+);
+
+CREATE TABLE IF NOT EXISTS track_audio_features (
+    track_id VARCHAR(255) PRIMARY KEY REFERENCES tracks(id),
+    danceability REAL,
+    energy REAL,
+    key INTEGER,
+    loudness REAL,
+    mode INTEGER,
+    speechiness REAL,
+    acousticness REAL,
+    instrumentalness REAL,
+    liveness REAL,
+    valence REAL,
+    tempo REAL,
+    time_signature INTEGER,
+    fetched_at TIMESTAMP WITHOUT TIME ZONE NOT NULL
+);
+
+-- Requests for audio features or popularity that returned nothing or failed,
+-- so the tracks are not requested again on every run.
+CREATE TABLE IF NOT EXISTS track_enrichment_attempts (
+    track_id VARCHAR(255) NOT NULL REFERENCES tracks(id),
+    kind VARCHAR(32) NOT NULL,
+    attempted_at TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+    PRIMARY KEY (track_id, kind)
+);
+
+CREATE TABLE IF NOT EXISTS listening_sessions (
+    started_at TIMESTAMP WITHOUT TIME ZONE PRIMARY KEY,
+    ended_at TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+    plays INTEGER NOT NULL,
+    ms_played BIGINT NOT NULL,
+    skips INTEGER NOT NULL,
+    first_track_id VARCHAR(255),
+    last_track_id VARCHAR(255)
+);
+
+CREATE INDEX IF NOT EXISTS listening_sessions_ended_at ON listening_sessions (ended_at);
+
+-- Single row bumped every time plays are added, so caches in other
+-- processes know the streaming history changed.
+CREATE TABLE IF NOT EXISTS streaming_history_version (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    version INTEGER NOT NULL
 );
\ No newline at end of file
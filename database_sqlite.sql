@@ -0,0 +1,162 @@
+CREATE TABLE IF NOT EXISTS genres (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    name VARCHAR(255) UNIQUE NOT NULL
+);
+
+-- Artists, albums and tracks are referenced by their integer surrogate key
+-- (sk), which is much smaller than the 22 characters Spotify id (id).
+CREATE TABLE IF NOT EXISTS artists (
+    sk INTEGER PRIMARY KEY AUTOINCREMENT,
+    id VARCHAR(255) UNIQUE NOT NULL,
+    name VARCHAR(255) NOT NULL,
+    popularity INTEGER,
+    followers INTEGER,
+    image_sm TEXT,
+    image_md TEXT,
+    image_lg TEXT
+);
+
+CREATE TABLE IF NOT EXISTS albums (
+    sk INTEGER PRIMARY KEY AUTOINCREMENT,
+    id VARCHAR(255) UNIQUE NOT NULL,
+    name VARCHAR(255) NOT NULL,
+    label VARCHAR(255),
+    popularity INTEGER,
+    release_date DATE,
+    total_tracks INTEGER,
+    image_sm TEXT,
+    image_md TEXT,
+    image_lg TEXT,
+    main_artist_id VARCHAR(255) REFERENCES artists(id)
+);
+
+CREATE TABLE IF NOT EXISTS tracks (
+    sk INTEGER PRIMARY KEY AUTOINCREMENT,
+    id VARCHAR(255) UNIQUE NOT NULL,
+    name VARCHAR(255) NOT NULL,
+    disc_number INTEGER,
+    duration INTEGER,
+    is_explicit BOOLEAN,
+    popularity INTEGER,
+    track_number INTEGER,
+    is_local BOOLEAN,
+    album_id VARCHAR(255) REFERENCES albums(id),
+    main_artist_id VARCHAR(255) REFERENCES artists(id)
+);
+
+CREATE TABLE IF NOT EXISTS streaming_history (
+    played_at TIMESTAMP NOT NULL,
+    ms_played INTEGER,
+    track_sk INTEGER NOT NULL REFERENCES tracks(sk),
+    context TEXT,
+    reason_start TEXT,
+    reason_end TEXT,
+    skipped BOOLEAN,
+    shuffle BOOLEAN,
+    PRIMARY KEY (played_at, track_sk)
+);
+
+CREATE TABLE IF NOT EXISTS album_artists (
+    album_sk INTEGER REFERENCES albums(sk),
+    artist_sk INTEGER REFERENCES artists(sk),
+    PRIMARY KEY (album_sk, artist_sk)
+);
+
+CREATE TABLE IF NOT EXISTS track_artists (
+    track_sk INTEGER REFERENCES tracks(sk),
+    artist_sk INTEGER REFERENCES artists(sk),
+    PRIMARY KEY (track_sk, artist_sk)
+);
+
+CREATE TABLE IF NOT EXISTS album_genres (
+    album_sk INTEGER REFERENCES albums(sk),
+    genre_id INT REFERENCES genres(id),
+    PRIMARY KEY (album_sk, genre_id)
+);
+
+CREATE TABLE IF NOT EXISTS artist_genres (
+    artist_sk INTEGER REFERENCES artists(sk),
+    genre_id INT REFERENCES genres(id),
+    PRIMARY KEY (artist_sk, genre_id)
+);
+
+CREATE TABLE IF NOT EXISTS failed_streaming_history (
+    played_at TIMESTAMP NOT NULL,
+    ms_played INTEGER,
+    track_id VARCHAR(255) NOT NULL,
+    context TEXT,
+    reason_start TEXT,
+    reason_end TEXT,
+    skipped BOOLEAN,
+    shuffle BOOLEAN,
+    failure_reason TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    status VARCHAR(16) NOT NULL DEFAULT 'pending',
+    last_attempt_at TIMESTAMP,
+    next_attempt_at TIMESTAMP NOT NULL,
+    PRIMARY KEY (played_at, track_id)
+);
+
+CREATE TABLE IF NOT EXISTS imported_files (
+    content_hash VARCHAR(64) PRIMARY KEY,
+    filename TEXT NOT NULL,
+    size BIGINT NOT NULL,
+    mtime REAL NOT NULL,
+    row_count INTEGER,
+    imported_at TIMESTAMP NOT NULL
+);
+
+-- Other names, sizes or modification times under which the content of an
+-- imported file was seen, e.g. copies, so they are skipped without hashing.
+CREATE TABLE IF NOT EXISTS imported_file_aliases (
+    filename TEXT NOT NULL,
+    size BIGINT NOT NULL,
+    mtime REAL NOT NULL,
+    content_hash VARCHAR(64) NOT NULL REFERENCES imported_files(content_hash),
+    PRIMARY KEY (filename, size, mtime)
+);
+
+CREATE TABLE IF NOT EXISTS track_audio_features (
+    track_id VARCHAR(255) PRIMARY KEY REFERENCES tracks(id),
+    danceability REAL,
+    energy REAL,
+    key INTEGER,
+    loudness REAL,
+    mode INTEGER,
+    speechiness REAL,
+    acousticness REAL,
+    instrumentalness REAL,
+    liveness REAL,
+    valence REAL,
+    tempo REAL,
+    time_signature INTEGER,
+    fetched_at TIMESTAMP NOT NULL
+);
+
+-- Requests for audio features or popularity that returned nothing or failed,
+-- so the tracks are not requested again on every run.
+CREATE TABLE IF NOT EXISTS track_enrichment_attempts (
+    track_id VARCHAR(255) NOT NULL REFERENCES tracks(id),
+    kind VARCHAR(32) NOT NULL,
+    attempted_at TIMESTAMP NOT NULL,
+    PRIMARY KEY (track_id, kind)
+);
+
+CREATE TABLE IF NOT EXISTS listening_sessions (
+    started_at TIMESTAMP PRIMARY KEY,
+    ended_at TIMESTAMP NOT NULL,
+    plays INTEGER NOT NULL,
+    ms_played BIGINT NOT NULL,
+    skips INTEGER NOT NULL,
+    first_track_id VARCHAR(255),
+    last_track_id VARCHAR(255)
+);
+
+CREATE INDEX IF NOT EXISTS listening_sessions_ended_at ON listening_sessions (ended_at);
+
+-- Single row bumped every time plays are added, so caches in other
+-- processes know the streaming history changed.
+CREATE TABLE IF NOT EXISTS streaming_history_version (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    version INTEGER NOT NULL
+);
\ No newline at end of file
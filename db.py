@@ -1,60 +1,235 @@
-import psycopg2
 import time
+import sqlite3
+from datetime import datetime
 from logger import logger
 from dotenv import load_dotenv
 import os
 
 load_dotenv()
 
+# Either "postgres" or "sqlite"
+DB_BACKEND = os.getenv("DB_BACKEND") or "postgres"
+
 DB_HOST = os.getenv("DB_HOST")
 DB_PORT = os.getenv("DB_PORT")
 DB_NAME = os.getenv("DB_NAME")
 DB_USER = os.getenv("DB_USER")
 DB_PASSWORD = os.getenv("DB_PASSWORD")
 
+# Only used by the sqlite backend
+DB_PATH = os.getenv("DB_PATH") or "spotify.db"
 
-def get_connection():
+
+class PostgresBackend:
+    """
+    Stores everything in a PostgreSQL server.
+    """
+
+    name = "postgres"
+    schema_file = "database.sql"
+    merge_file = "fix_history_merge.sql"
+    surrogate_keys_migration_file = "migrate_surrogate_keys.sql"
+
+    def __init__(self):
+        self.conn = None
+        # True while a write run with commit=False waits for the next commit
+        self.pending_writes = False
+
+    def get_connection(self):
+        """
+        Returns a connection to the database.
+
+        If the connection fails, it will retry 5 times before exiting.
+        """
+        if self.conn is not None and not self.conn.closed:
+            return self.conn
+
+        import psycopg2
+
+        # Retry 5 times
+        for _ in range(5):
+            try:
+                self.conn = psycopg2.connect(
+                    host=DB_HOST,
+                    port=DB_PORT,
+                    dbname=DB_NAME,
+                    user=DB_USER,
+                    password=DB_PASSWORD,
+                )
+                return self.conn
+            except Exception as e:
+                logger.warning(f"Failed to connect to database: {e}, retrying...")
+                time.sleep(1)
+        raise Exception("Failed to connect to database")
+
+    def query(self, query, params=None, commit=False, fetchall=False):
+        conn = self.get_connection()
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(query, params)
+                result = cursor.fetchall() if fetchall else None
+            if commit:
+                conn.commit()
+                self.pending_writes = False
+            elif not fetchall:
+                self.pending_writes = True
+            elif not self.pending_writes:
+                # psycopg2 opens a transaction for reads too, and the connection
+                # is kept open, so end it. Otherwise it sits idle in transaction
+                # holding locks, e.g. blocking --migrate while --serve runs.
+                conn.rollback()
+            return result
+        except Exception:
+            # Otherwise the connection is unusable until the end of the transaction
+            conn.rollback()
+            self.pending_writes = False
+            raise
+
+    def query_many(self, query, params_list):
+        from psycopg2.extras import execute_batch
+
+        conn = self.get_connection()
+        try:
+            with conn.cursor() as cursor:
+                execute_batch(cursor, query, params_list)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            self.pending_writes = False
+
+    def run_script(self, script):
+        self.query(script, commit=True)
+
+    def get_columns(self, table):
+        query = """
+        SELECT column_name FROM information_schema.columns
+        WHERE table_schema = current_schema() AND table_name = %s
+        """
+        return [row[0] for row in self.query(query, (table,), fetchall=True)]
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+
+
+class SQLiteBackend:
     """
-    Returns a connection to the database.
+    Stores everything in a local SQLite file, no server needed.
 
-    If the connection fails, it will retry 5 times before exiting.
+    Queries are written for psycopg2, so the %s placeholders are
+    translated to sqlite's ? before running them.
     """
-    # Retry 5 times
-    for _ in range(5):
+
+    name = "sqlite"
+    schema_file = "database_sqlite.sql"
+    merge_file = "fix_history_merge_sqlite.sql"
+    surrogate_keys_migration_file = "migrate_surrogate_keys_sqlite.sql"
+
+    def __init__(self):
+        self.conn = None
+
+    def get_connection(self):
+        if self.conn is None:
+            self.conn = sqlite3.connect(DB_PATH, detect_types=sqlite3.PARSE_DECLTYPES)
+            # Foreign keys are off by default in sqlite
+            self.conn.execute("PRAGMA foreign_keys = ON")
+        return self.conn
+
+    def query(self, query, params=None, commit=False, fetchall=False):
+        conn = self.get_connection()
         try:
-            conn = psycopg2.connect(
-                host=DB_HOST,
-                port=DB_PORT,
-                dbname=DB_NAME,
-                user=DB_USER,
-                password=DB_PASSWORD,
-            )
-            return conn
-        except Exception as e:
-            logger.warning(f"Failed to connect to database: {e}, retrying...")
-            time.sleep(1)
-    raise Exception("Failed to connect to database")
+            cursor = conn.execute(query.replace("%s", "?"), params or ())
+            result = cursor.fetchall() if fetchall else None
+            if commit:
+                conn.commit()
+            return result
+        except Exception:
+            conn.rollback()
+            raise
+
+    def query_many(self, query, params_list):
+        conn = self.get_connection()
+        try:
+            conn.executemany(query.replace("%s", "?"), params_list)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+    def run_script(self, script):
+        conn = self.get_connection()
+        conn.executescript(script)
+        conn.commit()
+
+    def get_columns(self, table):
+        query = "SELECT name FROM pragma_table_info(%s)"
+        return [row[0] for row in self.query(query, (table,), fetchall=True)]
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+
+
+# Timestamps are stored as ISO 8601 text in sqlite
+sqlite3.register_adapter(datetime, lambda d: d.isoformat(" "))
+sqlite3.register_converter("TIMESTAMP", lambda b: datetime.fromisoformat(b.decode()))
+
+BACKENDS = {
+    PostgresBackend.name: PostgresBackend,
+    SQLiteBackend.name: SQLiteBackend,
+}
+
+if DB_BACKEND not in BACKENDS:
+    logger.fatal(f"Unknown database backend: {DB_BACKEND}")
+    exit(1)
+
+backend = BACKENDS[DB_BACKEND]()
+
+
+def get_backend():
+    """
+    Returns the storage backend configured by DB_BACKEND.
+    """
+    return backend
+
+
+def get_connection():
+    """
+    Returns a connection to the database of the configured backend.
+    """
+    return backend.get_connection()
 
 
 def close_connection():
-    conn.close()
+    backend.close()
 
 
 def query_db(query, params=None, commit=False, fetchall=False):
     """
     Executes a query. Commits the transaction if commit=True.
     """
-    conn = get_connection()
-    with conn.cursor() as cursor:
-        cursor.execute(query, params)
-        if commit:
-            conn.commit()
-        if fetchall:
-            return cursor.fetchall()
+    return backend.query(query, params, commit=commit, fetchall=fetchall)
 
 
-try:
-    conn = get_connection()
-except Exception as e:
-    logger.fatal(f"Failed to connect to database: {e}")
-    exit(1)
+def get_columns(table):
+    """
+    Returns the names of the columns of a table.
+    """
+    return backend.get_columns(table)
+
+
+def query_db_many(query, params_list):
+    """
+    Executes a query once for each set of params and commits.
+    """
+    backend.query_many(query, params_list)
+
+
+def run_sql_file(filename):
+    """
+    Executes all queries of a .sql file at once and commits.
+    """
+    with open(filename) as f:
+        backend.run_script(f.read())
@@ -9,13 +9,15 @@
 -- The goal here is that every time a 'extended-history' is added I found these duplicates and merge them!
 -- Keeping all relevant information and removing duplicates.
 
+-- The connection is reused, so the temp tables of a previous merge may still exist
+DROP TABLE IF EXISTS x_streaming_history_duplicates, merged;
 
 -- Step 1: Create a temp table for duplicates
 CREATE TEMP TABLE x_streaming_history_duplicates AS
 SELECT
     played_at,
     ms_played,
-    track_id,
+    track_sk,
     context,
     reason_start,
     reason_end,
@@ -23,7 +25,7 @@ SELECT
     shuffle
 FROM (
     SELECT *,
-    COUNT(*) OVER (PARTITION BY date_trunc('second', played_at), track_id) AS cnt
+    COUNT(*) OVER (PARTITION BY date_trunc('second', played_at), track_sk) AS cnt
     FROM public.streaming_history
 ) sub
 WHERE cnt > 1;
@@ -32,7 +34,7 @@ WHERE cnt > 1;
 CREATE TEMP TABLE merged AS
 SELECT
     date_trunc('second', played_at) AS played_at,
-    track_id,
+    track_sk,
     MAX(ms_played) AS ms_played,
     MAX(context) AS context,
     MAX(reason_start) AS reason_start,
@@ -40,21 +42,21 @@ SELECT
     bool_or(skipped) AS skipped,
     bool_or(shuffle) AS shuffle
 FROM x_streaming_history_duplicates
-GROUP BY date_trunc('second', played_at), track_id;
+GROUP BY date_trunc('second', played_at), track_sk;
 
 -- Step 3: Remove duplicates from the original table
 DELETE FROM public.streaming_history
-WHERE (played_at, track_id) IN (
-    SELECT played_at, track_id
+WHERE (played_at, track_sk) IN (
+    SELECT played_at, track_sk
     FROM x_streaming_history_duplicates
 );
 
 -- Step 4: Add merged duplicates back to the original table
-INSERT INTO public.streaming_history (played_at, ms_played, track_id, context, reason_start, reason_end, skipped, shuffle)
+INSERT INTO public.streaming_history (played_at, ms_played, track_sk, context, reason_start, reason_end, skipped, shuffle)
 SELECT
     played_at,
     ms_played,
-    track_id,
+    track_sk,
     context,
     reason_start,
     reason_end,
@@ -0,0 +1,61 @@
+-- Same as fix_history_merge.sql, comments about why this is needed are there.
+-- Timestamps are stored as text in sqlite, so truncating to the second is done
+-- with strftime and the temp tables are dropped since the connection is reused.
+
+DROP TABLE IF EXISTS x_streaming_history_duplicates;
+DROP TABLE IF EXISTS merged;
+
+-- Step 1: Create a temp table for duplicates
+CREATE TEMP TABLE x_streaming_history_duplicates AS
+SELECT
+    played_at,
+    ms_played,
+    track_sk,
+    context,
+    reason_start,
+    reason_end,
+    skipped,
+    shuffle
+FROM (
+    SELECT *,
+    COUNT(*) OVER (PARTITION BY strftime('%Y-%m-%d %H:%M:%S', played_at), track_sk) AS cnt
+    FROM streaming_history
+) sub
+WHERE cnt > 1;
+
+-- Step 2: Create another temp table for merged duplicates
+CREATE TEMP TABLE merged AS
+SELECT
+    strftime('%Y-%m-%d %H:%M:%S', played_at) AS played_at,
+    track_sk,
+    MAX(ms_played) AS ms_played,
+    MAX(context) AS context,
+    MAX(reason_start) AS reason_start,
+    MAX(reason_end) AS reason_end,
+    MAX(skipped) AS skipped,
+    MAX(shuffle) AS shuffle
+FROM x_streaming_history_duplicates
+GROUP BY strftime('%Y-%m-%d %H:%M:%S', played_at), track_sk;
+
+-- Step 3: Remove duplicates from the original table
+DELETE FROM streaming_history
+WHERE (played_at, track_sk) IN (
+    SELECT played_at, track_sk
+    FROM x_streaming_history_duplicates
+);
+
+-- Step 4: Add merged duplicates back to the original table
+INSERT INTO streaming_history (played_at, ms_played, track_sk, context, reason_start, reason_end, skipped, shuffle)
+SELECT
+    played_at,
+    ms_played,
+    track_sk,
+    context,
+    reason_start,
+    reason_end,
+    skipped,
+    shuffle
+FROM merged;
+
+DROP TABLE x_streaming_history_duplicates;
+DROP TABLE merged;
\ No newline at end of file
@@ -1,7 +1,12 @@
 import spotipy
 from typing import List, Dict, Any
 from logger import logger
-from helpers import get_image_sizes, batch_generator, get_date_based_on_precision
+from helpers import (
+    get_image_sizes,
+    batch_generator,
+    get_date_based_on_precision,
+    wait_for_rate_limit,
+)
 from models import (
     insert_artist,
     insert_genre,
@@ -13,6 +18,9 @@ from models import (
     insert_track,
     insert_track_artist,
     insert_album_artist,
+    insert_track_audio_features,
+    update_track_popularity,
+    insert_track_enrichment_attempts,
 )
 
 
@@ -94,8 +102,12 @@ def search_and_insert_artists(
 
     # Request all artists
     logger.info(f"Querying {len(artist_ids)} artists from Spotify")
+    wait_for_rate_limit()
     artists = sp.artists(artist_ids)
 
+    # Unknown ids come back as None
+    artists["artists"] = [artist for artist in artists.get("artists", []) if artist]
+
     # Insert all artists
     for artist in artists.get("artists", []):
         # Get image sizes
@@ -160,8 +172,12 @@ def flow_insert_all_from_albums(
 
     # Request all albums
     logger.info(f"Querying {len(album_ids)} albums from Spotify")
+    wait_for_rate_limit()
     albums = sp.albums(album_ids)
 
+    # Unknown ids come back as None
+    albums["albums"] = [album for album in albums.get("albums", []) if album]
+
     # Get all artists
     artist_ids = set()
 
@@ -254,6 +270,7 @@ def flow_insert_all_from_albums(
         # I will query the next 50 tracks and insert them as well.
         while tracks.get("next"):
             logger.info(f"Querying next 50 tracks from album {album.get('id')}")
+            wait_for_rate_limit()
             tracks = sp.next(tracks)
             insert_track_list(tracks.get("items", []), album.get("id"), sp)
 
@@ -275,13 +292,108 @@ def flow_insert_all_from_tracks(
 
     # Request all tracks
     logger.info(f"Querying {len(track_ids)} tracks from Spotify")
+    wait_for_rate_limit()
     tracks = sp.tracks(track_ids)
 
-    # Get all album ids
+    # Get all album ids, unknown ids come back as None
     album_ids = set()
     for track in tracks.get("tracks", []):
-        album_ids.add(track.get("album", {}).get("id"))
+        if track and track.get("album", {}).get("id"):
+            album_ids.add(track["album"]["id"])
 
     # Now request and insert all albums in batches
     for batch in batch_generator(list(album_ids), 20):
         flow_insert_all_from_albums(batch, sp)
+
+
+def flow_insert_audio_features(track_ids: List[str], sp: spotipy.Spotify) -> None:
+    """
+    Requests the audio features of up to 100 tracks and inserts them in the
+    database.
+
+    Tracks without audio features are recorded, so they are not requested
+    again every run.
+    """
+    if len(track_ids) > 100:
+        # Log warning
+        logger.warning(
+            "Too many tracks to request audio features at once. Requesting only 100."
+        )
+        track_ids = track_ids[:100]
+
+    logger.info(f"Querying audio features of {len(track_ids)} tracks from Spotify")
+    wait_for_rate_limit()
+    features = sp.audio_features(track_ids)
+
+    # The response is in the same order as the request, with None for
+    # tracks that have no audio features.
+    rows = []
+    for track_id, feature in zip(track_ids, features):
+        if not feature:
+            continue
+        rows.append(
+            {
+                "track_id": track_id,
+                "danceability": feature.get("danceability"),
+                "energy": feature.get("energy"),
+                "key": feature.get("key"),
+                "loudness": feature.get("loudness"),
+                "mode": feature.get("mode"),
+                "speechiness": feature.get("speechiness"),
+                "acousticness": feature.get("acousticness"),
+                "instrumentalness": feature.get("instrumentalness"),
+                "liveness": feature.get("liveness"),
+                "valence": feature.get("valence"),
+                "tempo": feature.get("tempo"),
+                "time_signature": feature.get("time_signature"),
+            }
+        )
+
+    try:
+        logger.debug(f"Inserting audio features of {len(rows)} tracks")
+        insert_track_audio_features(rows)
+    except Exception as e:
+        logger.error(f"Failed to insert audio features of tracks {track_ids}: {e}")
+        rows = []
+
+    inserted = {row["track_id"] for row in rows}
+    missing = [track_id for track_id in track_ids if track_id not in inserted]
+    if missing:
+        logger.debug(f"No audio features for {len(missing)} tracks")
+        insert_track_enrichment_attempts(missing, "audio_features")
+
+
+def flow_update_popularity(track_ids: List[str], sp: spotipy.Spotify) -> None:
+    """
+    Requests up to 50 tracks and updates their popularity in the database.
+
+    Tracks inserted from album responses never have popularity. Tracks that
+    still have none are recorded, so they are not requested again every run.
+    """
+    if len(track_ids) > 50:
+        # Log warning
+        logger.warning("Too many tracks to request at once. Requesting only 50.")
+        track_ids = track_ids[:50]
+
+    logger.info(f"Querying popularity of {len(track_ids)} tracks from Spotify")
+    wait_for_rate_limit()
+    tracks = sp.tracks(track_ids)
+
+    popularity = [
+        (track.get("id"), track.get("popularity"))
+        for track in tracks.get("tracks", [])
+        if track and track.get("popularity") is not None
+    ]
+
+    try:
+        logger.debug(f"Updating popularity of {len(popularity)} tracks")
+        update_track_popularity(popularity)
+    except Exception as e:
+        logger.error(f"Failed to update popularity of tracks {track_ids}: {e}")
+        popularity = []
+
+    updated = {track_id for track_id, _ in popularity}
+    missing = [track_id for track_id in track_ids if track_id not in updated]
+    if missing:
+        logger.debug(f"No popularity for {len(missing)} tracks")
+        insert_track_enrichment_attempts(missing, "popularity")
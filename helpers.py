@@ -1,5 +1,22 @@
+import os
+import time
+from datetime import datetime, timedelta
 from typing import List, Dict, Optional, Tuple
-from db import query_db
+from db import query_db, get_backend, run_sql_file
+from logger import logger
+from models import needs_surrogate_keys_migration
+
+# Requests to the Spotify API are limited to this many per second
+SPOTIFY_REQUESTS_PER_SECOND = float(os.getenv("SPOTIFY_REQUESTS_PER_SECOND") or 2)
+
+# Failed streaming history is retried with exponential backoff, starting
+# at RETRY_BASE_DELAY and doubling until MAX_RETRY_ATTEMPTS is reached.
+RETRY_BASE_DELAY = timedelta(hours=1)
+MAX_RETRY_ATTEMPTS = 5
+
+# Tracks whose audio features or popularity could not be requested are
+# only requested again after this long.
+ENRICHMENT_RETRY_DELAY = timedelta(days=30)
 
 
 def get_image_sizes(
@@ -22,11 +39,24 @@ def get_image_sizes(
     return image_sm, image_md, image_lg
 
 
-def startup_database() -> None:
+def startup_database(migrate: bool = False) -> None:
     """
-    Read database.sql and execute the queries.
+    Read the schema of the configured backend (database.sql for postgres)
+    and execute the queries.
+
+    Databases created by older versions are only migrated if migrate=True,
+    otherwise this raises.
     """
-    with open("database.sql") as f:
+    # Databases created before surrogate keys existed are rewritten, so this
+    # only happens when asked for. Nothing is touched otherwise.
+    needs_migration = needs_surrogate_keys_migration()
+    if needs_migration and not migrate:
+        raise Exception(
+            "The database was created by an older version and must be migrated "
+            "to surrogate keys. Back it up and run again with --migrate"
+        )
+
+    with open(get_backend().schema_file) as f:
         queries = f.read().split(";")
 
     # TODO: Do this without query_db function, write custom here
@@ -34,6 +64,10 @@ def startup_database() -> None:
         if query.strip():
             query_db(query, commit=True)
 
+    if needs_migration:
+        logger.info("Migrating the database to surrogate keys, this may take a while")
+        run_sql_file(get_backend().surrogate_keys_migration_file)
+
 
 def get_date_based_on_precision(precision: str, date: str) -> str:
     """
@@ -57,3 +91,34 @@ def batch_generator(lst, n):
     """Yield successive n sized chunks from lst."""
     for i in range(0, len(lst), n):
         yield lst[i : i + n]
+
+
+def get_retry_delay(attempts: int) -> timedelta:
+    """
+    Returns how long to wait before the next retry after a number of attempts.
+    1 -> 1h, 2 -> 2h, 3 -> 4h, ...
+    """
+    return RETRY_BASE_DELAY * 2 ** max(attempts - 1, 0)
+
+
+def parse_timestamp(ts: str) -> datetime:
+    """
+    Parses a timestamp returned by Spotify into a naive UTC datetime.
+    2024-01-01T12:34:56.789Z -> datetime(2024, 1, 1, 12, 34, 56, 789000)
+    """
+    return datetime.fromisoformat(ts.rstrip("Z"))
+
+
+_last_request_at = 0.0
+
+
+def wait_for_rate_limit() -> None:
+    """
+    Sleeps as needed so requests to Spotify are made at most
+    SPOTIFY_REQUESTS_PER_SECOND times per second. Call it before every request.
+    """
+    global _last_request_at
+    wait = _last_request_at + 1 / SPOTIFY_REQUESTS_PER_SECOND - time.monotonic()
+    if wait > 0:
+        time.sleep(wait)
+    _last_request_at = time.monotonic()
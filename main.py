@@ -1,122 +1,174 @@
-import os
 import json
 import spotipy
 import argparse
 from spotipy.oauth2 import SpotifyOAuth
-from db import close_connection, query_db
+from db import close_connection, run_sql_file, get_backend
 from logger import logger
 from models import (
     insert_streaming_history,
     get_object_by_id,
     is_streaming_history_added,
     get_new_ids,
+    insert_failed_streaming_history,
+    update_failed_streaming_history,
+    delete_failed_streaming_history,
+    get_due_failed_streaming_history,
+    get_failed_streaming_history_keys,
+    get_tracks_without_audio_features,
+    get_tracks_without_popularity,
+    load_sks,
+    get_sk,
+    insert_track_enrichment_attempts,
+    bump_streaming_history_version,
 )
-from helpers import startup_database, batch_generator
-from flows import flow_insert_all_from_albums, flow_insert_all_from_tracks
+from helpers import (
+    startup_database,
+    batch_generator,
+    get_retry_delay,
+    parse_timestamp,
+    wait_for_rate_limit,
+    MAX_RETRY_ATTEMPTS,
+    ENRICHMENT_RETRY_DELAY,
+)
+from normalize import normalize_extended_history
+from flows import (
+    flow_insert_all_from_albums,
+    flow_insert_all_from_tracks,
+    flow_insert_audio_features,
+    flow_update_popularity,
+)
+from planner import plan_extended_history, log_plan
+from manifest import (
+    get_new_export_files,
+    mark_files_as_imported,
+    EXTENDED_HISTORY_PATH,
+)
+from stats import invalidate_cache, serve_stats, STATS_PORT
+from profiling import enable_profiling, profile_phase
+from sessions import update_listening_sessions, rebuild_listening_sessions
 import time
+from datetime import datetime
+from typing import List, Dict, Any, Tuple
 
 
-def load_extended_history(dir: str):
+def load_extended_history(files: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
     """
-    Load all *.json inside a directory into a single list of dictionaries.
+    Load all export files into a single list of dictionaries, parsing the
+    content read by get_new_export_files.
+
+    The number of rows of each file is stored in its "row_count".
     """
     data = []
 
-    for filename in os.listdir(dir):
-        if filename.endswith(".json"):
-            with open(os.path.join(dir, filename)) as f:
-                data.extend(json.load(f))
+    for file in files:
+        # The raw content is not needed anymore once parsed
+        rows = json.loads(file.pop("content"))
+        file["row_count"] = len(rows)
+        data.extend(rows)
 
     return data
 
 
-def add_extended_history(sp: spotipy.Spotify):
-    extended_history = load_extended_history("extended_history")
+def add_extended_history(sp: spotipy.Spotify, path: str = EXTENDED_HISTORY_PATH):
+    # Reading and hashing the files is part of loading them
+    with profile_phase("load"):
+        files = get_new_export_files(path)
+        raw_history = load_extended_history(files)
+        extended_history = normalize_extended_history(raw_history)
+
+    if not files:
+        logger.info("No new extended history files to add")
+        return
+
     logger.info(
-        f"Loaded {len(extended_history)} items from extended history, adding to database. This may take a while."
+        f"Loaded {len(raw_history)} items from {len(files)} new extended history files, "
+        f"{len(raw_history) - len(extended_history)} were podcasts or duplicates. "
+        f"Adding {len(extended_history)} to database. This may take a while."
     )
 
-    # First step is to make sure all songs were added to the database
-    # So I will do an outer batch of 10 in 10 songs until I found 40-50 songs
-    # that are not in the database.
-    # Then I will request them all until I finished all extended history.
-    outer_batch = []
-    for inner_batch in batch_generator(extended_history, 10):
-        ids = []
-        for item in inner_batch:
-            try:
-                track_id = item.get("spotify_track_uri").replace("spotify:track:", "")
-                ids.append(track_id)
-            except Exception:
-                logger.warning("Failed to get track id, likely a podcast.")
-                continue
-
-        outer_batch.extend(get_new_ids("tracks", ids))
-        if len(outer_batch) >= 40:
-            # Send to the flow
-            flow_insert_all_from_tracks(outer_batch, sp)
-            outer_batch = []
+    # First step is to make sure all songs were added to the database.
+    # I find all the songs that are not in the database and only then request
+    # them in batches of 50, which is the most Spotify allows per request.
+    with profile_phase("id_discovery"):
+        track_ids = list(dict.fromkeys(item["track_id"] for item in extended_history))
+        new_track_ids = []
+        for batch in batch_generator(track_ids, 1000):
+            new_track_ids.extend(get_new_ids("tracks", batch))
+
+    logger.info(f"Found {len(new_track_ids)} tracks that are not in the database")
+
+    # Tracks that could not be added, their plays go to the dead-letter table
+    fetch_errors = {}
+    with profile_phase("metadata_fetch"):
+        for batch in batch_generator(new_track_ids, 50):
+            fetch_errors.update(insert_tracks(batch, sp))
             # For good measure I will sleep a bit
             time.sleep(3)
 
     # Only now that I will go over the extended history and add the streaming history
-    for data in extended_history:
-        try:
-            track_id = data.get("spotify_track_uri").replace("spotify:track:", "")
-        except Exception:
-            # This is just a podcast, I've logged about it above, here I just
-            # ignore.
-            continue
+    added_plays = []
+    with profile_phase("history_insert"):
+        # Plays that are already in the dead-letter table are left for the retry pass
+        failed_keys = get_failed_streaming_history_keys()
 
-        if is_streaming_history_added(data.get("ts"), track_id):
-            continue
+        # Look up the surrogate keys of all tracks at once instead of per play
+        track_ids = list({data["track_id"] for data in extended_history})
+        for batch in batch_generator(track_ids, 1000):
+            load_sks("tracks", batch)
+
+        for data in extended_history:
+            track_id = data["track_id"]
+
+            if (data["played_at"], track_id) in failed_keys:
+                continue
+
+            if is_streaming_history_added(data["played_at"], track_id):
+                continue
 
-        try:
-            logger.debug(
-                f"Inserting streaming history for track {track_id} at {data.get('ts')}"
-            )
-            insert_streaming_history(
-                data.get("ts"),
-                data.get("ms_played"),
-                track_id,
-                # Context is always None when coming from extended history
-                None,
-                data.get("reason_start"),
-                data.get("reason_end"),
-                data.get("skipped"),
-                data.get("shuffle"),
-            )
-        except Exception as e:
-            logger.warning(
-                f"Failed to insert streaming history for track {track_id}. WILL TRY AGAIN: {e}"
-            )
-            # I will try again by actually inserting the track
             try:
-                flow_insert_all_from_tracks([track_id], sp)
+                logger.debug(
+                    f"Inserting streaming history for track {track_id} at {data['played_at']}"
+                )
                 insert_streaming_history(
-                    data.get("ts"),
-                    data.get("ms_played"),
+                    data["played_at"],
+                    data["ms_played"],
                     track_id,
                     # Context is always None when coming from extended history
                     None,
-                    data.get("reason_start"),
-                    data.get("reason_end"),
-                    data.get("skipped"),
-                    data.get("shuffle"),
+                    data["reason_start"],
+                    data["reason_end"],
+                    data["skipped"],
+                    data["shuffle"],
                 )
+                added_plays.append((data["played_at"], data["ms_played"]))
             except Exception as e:
-                logger.error(
-                    f"Failed to insert streaming history for track {track_id} even after trying to insert it: {e}"
+                error = fetch_errors.get(track_id, e)
+                logger.warning(
+                    f"Failed to insert streaming history for track {track_id}, adding it to the retry queue: {error}"
+                )
+                add_failed_streaming_history(
+                    {**data, "context": None},
+                    error,
+                    fetch_failed=track_id in fetch_errors,
                 )
 
+    # Retry everything that failed in batches, instead of one track at a time
+    with profile_phase("retry"):
+        added_plays.extend(retry_failed_streaming_history(sp))
+
     # Merge possible "duplicates" between the extended history and the recently played
     # Comments for this are in the fix_history_merge.sql file
-    try:
-        with open("fix_history_merge.sql") as f:
-            query = f.read()
-            query_db(query, commit=True)
-    except Exception as e:
-        logger.error(f"Failed to merge history: {e}")
+    with profile_phase("merge"):
+        try:
+            run_sql_file(get_backend().merge_file)
+        except Exception as e:
+            logger.error(f"Failed to merge history: {e}")
+
+    # Everything in these files is either added or waiting in the retry queue
+    mark_files_as_imported(files)
+
+    with profile_phase("sessions"):
+        on_plays_added(added_plays)
 
 
 def add_recently_played(sp: spotipy.Spotify):
@@ -124,13 +176,14 @@ def add_recently_played(sp: spotipy.Spotify):
     Queries Spotify for the user's recently played tracks and inserts them into the database.
     """
     logger.info("Querying recently played tracks from Spotify")
+    wait_for_rate_limit()
     recently_played = sp.current_user_recently_played(limit=50)
 
     # Find all albums that are not in the database
     album_ids = set()
 
     for track in recently_played.get("items", []):
-        album_id = track.get("track", {}).get("album", {}).get("id")
+        album_id = ((track.get("track") or {}).get("album") or {}).get("id")
         if album_id and not get_object_by_id(album_id, "albums"):
             album_ids.add(album_id)
 
@@ -141,40 +194,265 @@ def add_recently_played(sp: spotipy.Spotify):
 
     # Now I can insert the streaming history since I know I have
     # the track in the database.
+    added_plays = []
     for track in recently_played.get("items", []):
-        track_id = track.get("track", {}).get("id")
+        track_id = (track.get("track") or {}).get("id")
+        ms_played = (track.get("track") or {}).get("duration_ms")
+        # Context is null when playing from e.g. search results
+        context = (track.get("context") or {}).get("type")
+        if not track_id or not track.get("played_at"):
+            logger.error(
+                f"Skipping recently played item without track or time: {track}"
+            )
+            continue
+        # Parsed so it is stored the same way by every storage backend
+        played_at = parse_timestamp(track.get("played_at"))
 
-        if is_streaming_history_added(track.get("played_at"), track_id):
+        if is_streaming_history_added(played_at, track_id):
             continue
 
         try:
             logger.debug(
-                f"Inserting streaming history for track {track_id} at {track.get('played_at')}"
+                f"Inserting streaming history for track {track_id} at {played_at}"
             )
             insert_streaming_history(
-                track.get("played_at"),
-                track.get("track", {}).get("duration_ms"),
+                played_at,
+                ms_played,
                 track_id,
-                track.get("context", {}).get("type"),
+                context,
                 # The rest here is always None when coming from recently played
                 None,
                 None,
                 None,
                 None,
             )
+            added_plays.append((played_at, ms_played))
         except Exception as e:
+            # Only plays of tracks that are missing can succeed on a retry
+            if get_sk("tracks", track_id) is not None:
+                logger.error(
+                    f"Failed to insert streaming history for track {track_id}: {e}"
+                )
+                continue
+
             logger.error(
-                f"Failed to insert streaming history for track {track_id}: {e}"
+                f"Failed to insert streaming history for track {track_id}, adding it to the retry queue: {e}"
+            )
+            add_failed_streaming_history(
+                {
+                    "played_at": played_at,
+                    "ms_played": ms_played,
+                    "track_id": track_id,
+                    "context": context,
+                    "reason_start": None,
+                    "reason_end": None,
+                    "skipped": None,
+                    "shuffle": None,
+                },
+                e,
             )
 
+    added_plays.extend(retry_failed_streaming_history(sp))
+    on_plays_added(added_plays)
+
+
+def enrich_tracks(sp: spotipy.Spotify):
+    """
+    Adds audio features and popularity to tracks that don't have them yet.
+
+    Only tracks missing them are requested, in batches of 100 for audio
+    features and 50 for popularity, so this is cheap to run after every import.
+    Tracks that failed are only requested again after ENRICHMENT_RETRY_DELAY.
+    """
+    retry_before = datetime.now() - ENRICHMENT_RETRY_DELAY
+
+    track_ids = get_tracks_without_audio_features(retry_before)
+    if track_ids:
+        logger.info(f"Adding audio features to {len(track_ids)} tracks")
+    for batch in batch_generator(track_ids, 100):
+        try:
+            flow_insert_audio_features(batch, sp)
+        except Exception as e:
+            logger.error(f"Failed to add audio features to tracks {batch}: {e}")
+            add_track_enrichment_attempts(batch, "audio_features")
+
+    track_ids = get_tracks_without_popularity(retry_before)
+    if track_ids:
+        logger.info(f"Adding popularity to {len(track_ids)} tracks")
+    for batch in batch_generator(track_ids, 50):
+        try:
+            flow_update_popularity(batch, sp)
+        except Exception as e:
+            logger.error(f"Failed to add popularity to tracks {batch}: {e}")
+            add_track_enrichment_attempts(batch, "popularity")
 
-def main():
 
+def add_track_enrichment_attempts(track_ids: List[str], kind: str):
+    """
+    Records a failed request for the audio features or popularity of tracks,
+    so they are not requested again on every run.
+    """
     try:
-        startup_database()
+        insert_track_enrichment_attempts(track_ids, kind)
     except Exception as e:
-        logger.fatal(f"Failed to start database: {e}")
-        exit(1)
+        logger.error(f"Failed to record the {kind} attempt of tracks {track_ids}: {e}")
+
+
+def on_plays_added(plays: List[Tuple[datetime, int]]):
+    """
+    Refreshes everything derived from the streaming history after new plays,
+    as (played_at, ms_played), were added.
+    """
+    if not plays:
+        return
+
+    # Lets processes serving stats know their cached results are stale
+    try:
+        bump_streaming_history_version()
+    except Exception as e:
+        logger.error(f"Failed to mark the streaming history as changed: {e}")
+
+    invalidate_cache()
+    try:
+        update_listening_sessions(plays)
+    except Exception as e:
+        logger.error(f"Failed to update listening sessions: {e}")
+
+
+def insert_tracks(track_ids: List[str], sp: spotipy.Spotify) -> Dict[str, Exception]:
+    """
+    Requests up to 50 tracks and inserts them with their albums and artists.
+
+    Returns the error of every track that is still not in the database. If
+    Spotify rejects the request because of a malformed id, the batch is split
+    in halves until the bad id is found, so it doesn't fail the others.
+    """
+    try:
+        flow_insert_all_from_tracks(track_ids, sp)
+    except Exception as e:
+        malformed = isinstance(e, spotipy.SpotifyException) and e.http_status == 400
+        if not malformed or len(track_ids) == 1:
+            logger.error(f"Failed to insert tracks {track_ids}: {e}")
+            return {track_id: e for track_id in get_new_ids("tracks", track_ids)}
+
+        logger.warning(
+            f"Spotify rejected tracks {track_ids}, splitting them to find the bad id: {e}"
+        )
+        half = len(track_ids) // 2
+        errors = insert_tracks(track_ids[:half], sp)
+        errors.update(insert_tracks(track_ids[half:], sp))
+        return errors
+
+    return {
+        track_id: ValueError(f"Track {track_id} was not found on Spotify")
+        for track_id in get_new_ids("tracks", track_ids)
+    }
+
+
+def add_failed_streaming_history(
+    data: dict, error: Exception, fetch_failed: bool = False
+):
+    """
+    Adds a streaming history record that failed to be inserted into the
+    dead-letter table. It is due for a retry right away, unless its track
+    was already requested from Spotify in this run and failed.
+    """
+    next_attempt_at = datetime.now()
+    if fetch_failed:
+        next_attempt_at += get_retry_delay(1)
+
+    try:
+        insert_failed_streaming_history(
+            data["played_at"],
+            data["ms_played"],
+            data["track_id"],
+            data["context"],
+            data["reason_start"],
+            data["reason_end"],
+            data["skipped"],
+            data["shuffle"],
+            str(error),
+            next_attempt_at,
+        )
+    except Exception as e:
+        logger.error(
+            f"Failed to add streaming history for track {data['track_id']} to the retry queue: {e}"
+        )
+
+
+def retry_failed_streaming_history(sp: spotipy.Spotify) -> List[Tuple[datetime, int]]:
+    """
+    Retries all streaming history records in the dead-letter table that are due.
+
+    Missing tracks are requested in batches of 50. Records that still fail
+    are pushed back with exponential backoff, after MAX_RETRY_ATTEMPTS they
+    are marked as permanently failed and never retried again.
+
+    Returns the (played_at, ms_played) of the records that were added.
+    """
+    now = datetime.now()
+    failed = get_due_failed_streaming_history(now)
+    if not failed:
+        return []
+
+    logger.info(f"Retrying {len(failed)} failed streaming history records")
+
+    # Request all missing tracks at once, in fully packed batches
+    track_ids = get_new_ids("tracks", list({data["track_id"] for data in failed}))
+    fetch_errors = {}
+    for batch in batch_generator(track_ids, 50):
+        fetch_errors.update(insert_tracks(batch, sp))
+
+    added_plays = []
+    for data in failed:
+        track_id = data["track_id"]
+        try:
+            insert_streaming_history(
+                data["played_at"],
+                data["ms_played"],
+                track_id,
+                data["context"],
+                data["reason_start"],
+                data["reason_end"],
+                data["skipped"],
+                data["shuffle"],
+            )
+            delete_failed_streaming_history(data["played_at"], track_id)
+            added_plays.append((data["played_at"], data["ms_played"]))
+            continue
+        except Exception as e:
+            error = fetch_errors.get(track_id, e)
+
+        attempts = data["attempts"] + 1
+        status = "failed" if attempts >= MAX_RETRY_ATTEMPTS else "pending"
+        if status == "failed":
+            logger.error(
+                f"Giving up on streaming history for track {track_id} at {data['played_at']} after {attempts} attempts: {error}"
+            )
+        else:
+            logger.warning(
+                f"Failed to insert streaming history for track {track_id} at {data['played_at']}, attempt {attempts}: {error}"
+            )
+
+        try:
+            update_failed_streaming_history(
+                data["played_at"],
+                track_id,
+                str(error),
+                attempts,
+                status,
+                now,
+                now + get_retry_delay(attempts),
+            )
+        except Exception as e:
+            logger.error(
+                f"Failed to update retry state for track {track_id} at {data['played_at']}: {e}"
+            )
+
+    return added_plays
+
+
+def main():
 
     parser = argparse.ArgumentParser(
         description="CLI tool for Spotify data management."
@@ -195,6 +473,45 @@ def main():
         action="store_true",
         help="Load extended streaming history, takes a while",
     )
+    parser.add_argument(
+        "--extended-history-path",
+        help=f"Zip archive or directory with the extended streaming history, defaults to {EXTENDED_HISTORY_PATH}",
+    )
+    parser.add_argument(
+        "--plan",
+        action="store_true",
+        help="Estimate what --extended-history would do without requesting or writing anything",
+    )
+    parser.add_argument(
+        "--retry-failed",
+        action="store_true",
+        help="Retry streaming history that previously failed to be added",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Profile CPU and memory of each import phase, results are saved next to spotify.log",
+    )
+    parser.add_argument(
+        "--rebuild-sessions",
+        action="store_true",
+        help="Recompute all listening sessions from the whole streaming history",
+    )
+    parser.add_argument(
+        "--serve",
+        action="store_true",
+        help="Serve listening stats as JSON over HTTP on localhost",
+    )
+    parser.add_argument(
+        "--migrate",
+        action="store_true",
+        help="Migrate a database created by an older version, back it up first",
+    )
+    parser.add_argument(
+        "--port",
+        type=int,
+        help=f"Port used by --serve, defaults to {STATS_PORT}",
+    )
 
     scope = "user-read-recently-played"
     sp = spotipy.Spotify(auth_manager=SpotifyOAuth(scope=scope))
@@ -211,18 +528,58 @@ def main():
     if args.debug:
         logger.setLevel("DEBUG")
 
-    if args.extended_history or args.recently_played:
+    try:
+        startup_database(migrate=args.migrate)
+    except Exception as e:
+        logger.fatal(f"Failed to start database: {e}")
+        exit(1)
+
+    if args.profile:
+        enable_profiling()
+
+    extended_history_path = args.extended_history_path or EXTENDED_HISTORY_PATH
+
+    if args.plan:
+        logger.info("Planning extended history import, nothing will be added")
+        extended_history = normalize_extended_history(
+            load_extended_history(
+                get_new_export_files(extended_history_path, read_only=True)
+            )
+        )
+        log_plan(plan_extended_history(extended_history))
+
+    elif (
+        args.extended_history
+        or args.recently_played
+        or args.retry_failed
+        or args.rebuild_sessions
+    ):
         # Log that it started
         logger.info("Starting...")
 
         if args.extended_history:
-            add_extended_history(sp)
+            add_extended_history(sp, extended_history_path)
 
         if args.recently_played:
-            add_recently_played(sp)
+            with profile_phase("recently_played"):
+                add_recently_played(sp)
+
+        if args.retry_failed:
+            on_plays_added(retry_failed_streaming_history(sp))
+
+        if args.rebuild_sessions:
+            rebuild_listening_sessions()
+
+        # Tracks added by the imports above are enriched incrementally
+        if args.extended_history or args.recently_played:
+            with profile_phase("enrichment"):
+                enrich_tracks(sp)
 
         logger.info("Finished")
 
+    if args.serve:
+        serve_stats(args.port or STATS_PORT)
+
     # Close the database connection
     close_connection()
 
@@ -0,0 +1,160 @@
+import os
+import time
+import fnmatch
+import hashlib
+import zipfile
+from contextlib import contextmanager
+from datetime import datetime
+from typing import List, Dict, Any, Iterator, IO
+from logger import logger
+from models import (
+    get_imported_files,
+    insert_imported_file,
+    insert_imported_file_alias,
+)
+
+# Where the export is read from, either a directory or Spotify's zip archive
+EXTENDED_HISTORY_PATH = os.getenv("EXTENDED_HISTORY_PATH") or "extended_history"
+
+# Only the audio history is read out of the archive, it also has video history
+ZIP_MEMBER_PATTERN = "Streaming_History_Audio_*.json"
+
+
+@contextmanager
+def open_export_file(file: Dict[str, Any]) -> Iterator[IO[bytes]]:
+    """
+    Opens an export file for reading, streaming it out of its zip archive if
+    it is a member of one instead of a loose file.
+    """
+    if file.get("member") is None:
+        with open(file["path"], "rb") as f:
+            yield f
+        return
+
+    with zipfile.ZipFile(file["path"]) as archive:
+        with archive.open(file["member"]) as f:
+            yield f
+
+
+def _list_export_files(path: str) -> List[Dict[str, Any]]:
+    """
+    Lists the export files of a zip archive, or the *.json and the archives
+    inside a directory, with their size and modification time.
+    """
+    if zipfile.is_zipfile(path):
+        files = []
+        with zipfile.ZipFile(path) as archive:
+            for info in archive.infolist():
+                filename = os.path.basename(info.filename)
+                if not fnmatch.fnmatch(filename, ZIP_MEMBER_PATTERN):
+                    continue
+                files.append(
+                    {
+                        "path": path,
+                        "member": info.filename,
+                        "filename": filename,
+                        "size": info.file_size,
+                        "mtime": time.mktime(info.date_time + (0, 0, -1)),
+                    }
+                )
+        return sorted(files, key=lambda f: f["filename"])
+
+    files = []
+    for filename in sorted(os.listdir(path)):
+        file_path = os.path.join(path, filename)
+        if filename.endswith(".zip"):
+            files.extend(_list_export_files(file_path))
+        elif filename.endswith(".json"):
+            stat = os.stat(file_path)
+            files.append(
+                {
+                    "path": file_path,
+                    "member": None,
+                    "filename": filename,
+                    "size": stat.st_size,
+                    "mtime": stat.st_mtime,
+                }
+            )
+    return files
+
+
+def get_new_export_files(
+    path: str = EXTENDED_HISTORY_PATH, read_only: bool = False
+) -> List[Dict[str, Any]]:
+    """
+    Returns all export files that were not imported yet. The path can be
+    Spotify's zip archive or a directory with *.json files and/or archives.
+
+    A file with the same name, size and modification time of an imported
+    one is skipped without being read. Otherwise its content is read and
+    hashed, so files that were only renamed or touched, or extracted from an
+    archive that was imported before, are skipped as well. The content is
+    kept in "content" so it doesn't have to be read again to be loaded.
+
+    Files with the same content as another new file, e.g. an archive next to
+    its extracted files, are only returned once. The other names are kept in
+    "aliases" and recorded when the file is marked as imported.
+
+    With read_only=True the manifest is not updated for those files, e.g.
+    when only planning an import.
+    """
+    imported = get_imported_files()
+    imported_stats = {(f["filename"], f["size"], f["mtime"]) for f in imported}
+    imported_hashes = {f["content_hash"] for f in imported}
+
+    new_files = {}
+    for file in _list_export_files(path):
+        filename = file["filename"]
+        if (filename, file["size"], file["mtime"]) in imported_stats:
+            logger.debug(f"Skipping {filename}, already imported")
+            continue
+
+        with open_export_file(file) as f:
+            content = f.read()
+        content_hash = hashlib.sha256(content).hexdigest()
+        if content_hash in imported_hashes:
+            logger.debug(f"Skipping {filename}, same content was already imported")
+            # Next time the fast check will be enough
+            if not read_only:
+                insert_imported_file_alias(
+                    content_hash, filename, file["size"], file["mtime"]
+                )
+            continue
+
+        if content_hash in new_files:
+            logger.debug(f"Skipping {filename}, same content as another new file")
+            new_files[content_hash]["aliases"].append(file)
+            continue
+
+        file["content_hash"] = content_hash
+        file["content"] = content
+        file["aliases"] = []
+        new_files[content_hash] = file
+
+    return list(new_files.values())
+
+
+def mark_files_as_imported(files: List[Dict[str, Any]]) -> None:
+    """
+    Records the files in the manifest, so they are skipped on the next runs.
+    """
+    now = datetime.now()
+    for file in files:
+        try:
+            insert_imported_file(
+                file["content_hash"],
+                file["filename"],
+                file["size"],
+                file["mtime"],
+                file.get("row_count"),
+                now,
+            )
+            for alias in file["aliases"]:
+                insert_imported_file_alias(
+                    file["content_hash"],
+                    alias["filename"],
+                    alias["size"],
+                    alias["mtime"],
+                )
+        except Exception as e:
+            logger.error(f"Failed to mark {file['filename']} as imported: {e}")
@@ -0,0 +1,77 @@
+-- Migrates a database created before surrogate keys existed.
+-- Artists, albums and tracks get an integer 'sk' primary key and every table
+-- that references them per play or per association uses it instead of the
+-- Spotify id, which is kept as a unique column.
+-- Runs automatically on startup when 'tracks' has no 'sk' column.
+
+-- Step 1: Add the surrogate keys, SERIAL fills them for existing rows
+ALTER TABLE artists ADD COLUMN sk SERIAL;
+ALTER TABLE albums ADD COLUMN sk SERIAL;
+ALTER TABLE tracks ADD COLUMN sk SERIAL;
+
+-- Step 2: Swap the primary keys. CASCADE drops every foreign key to the ids,
+-- the ones that still reference ids are added back afterwards.
+ALTER TABLE artists DROP CONSTRAINT artists_pkey CASCADE;
+ALTER TABLE artists ADD PRIMARY KEY (sk);
+ALTER TABLE artists ADD CONSTRAINT artists_id_key UNIQUE (id);
+
+ALTER TABLE albums DROP CONSTRAINT albums_pkey CASCADE;
+ALTER TABLE albums ADD PRIMARY KEY (sk);
+ALTER TABLE albums ADD CONSTRAINT albums_id_key UNIQUE (id);
+
+ALTER TABLE tracks DROP CONSTRAINT tracks_pkey CASCADE;
+ALTER TABLE tracks ADD PRIMARY KEY (sk);
+ALTER TABLE tracks ADD CONSTRAINT tracks_id_key UNIQUE (id);
+
+ALTER TABLE albums ADD FOREIGN KEY (main_artist_id) REFERENCES artists(id);
+ALTER TABLE tracks ADD FOREIGN KEY (album_id) REFERENCES albums(id);
+ALTER TABLE tracks ADD FOREIGN KEY (main_artist_id) REFERENCES artists(id);
+ALTER TABLE track_audio_features ADD FOREIGN KEY (track_id) REFERENCES tracks(id);
+ALTER TABLE track_enrichment_attempts ADD FOREIGN KEY (track_id) REFERENCES tracks(id);
+
+-- Step 3: Streaming history
+ALTER TABLE streaming_history ADD COLUMN track_sk INTEGER;
+UPDATE streaming_history SET track_sk = tracks.sk
+FROM tracks WHERE tracks.id = streaming_history.track_id;
+ALTER TABLE streaming_history DROP CONSTRAINT streaming_history_pkey;
+ALTER TABLE streaming_history DROP COLUMN track_id;
+ALTER TABLE streaming_history ALTER COLUMN track_sk SET NOT NULL;
+ALTER TABLE streaming_history ADD PRIMARY KEY (played_at, track_sk);
+ALTER TABLE streaming_history ADD FOREIGN KEY (track_sk) REFERENCES tracks(sk);
+
+-- Step 4: Associations
+ALTER TABLE album_artists ADD COLUMN album_sk INTEGER, ADD COLUMN artist_sk INTEGER;
+UPDATE album_artists SET album_sk = albums.sk, artist_sk = artists.sk
+FROM albums, artists
+WHERE albums.id = album_artists.album_id AND artists.id = album_artists.artist_id;
+ALTER TABLE album_artists DROP CONSTRAINT album_artists_pkey;
+ALTER TABLE album_artists DROP COLUMN album_id, DROP COLUMN artist_id;
+ALTER TABLE album_artists ADD PRIMARY KEY (album_sk, artist_sk);
+ALTER TABLE album_artists ADD FOREIGN KEY (album_sk) REFERENCES albums(sk);
+ALTER TABLE album_artists ADD FOREIGN KEY (artist_sk) REFERENCES artists(sk);
+
+ALTER TABLE track_artists ADD COLUMN track_sk INTEGER, ADD COLUMN artist_sk INTEGER;
+UPDATE track_artists SET track_sk = tracks.sk, artist_sk = artists.sk
+FROM tracks, artists
+WHERE tracks.id = track_artists.track_id AND artists.id = track_artists.artist_id;
+ALTER TABLE track_artists DROP CONSTRAINT track_artists_pkey;
+ALTER TABLE track_artists DROP COLUMN track_id, DROP COLUMN artist_id;
+ALTER TABLE track_artists ADD PRIMARY KEY (track_sk, artist_sk);
+ALTER TABLE track_artists ADD FOREIGN KEY (track_sk) REFERENCES tracks(sk);
+ALTER TABLE track_artists ADD FOREIGN KEY (artist_sk) REFERENCES artists(sk);
+
+ALTER TABLE album_genres ADD COLUMN album_sk INTEGER;
+UPDATE album_genres SET album_sk = albums.sk
+FROM albums WHERE albums.id = album_genres.album_id;
+ALTER TABLE album_genres DROP CONSTRAINT album_genres_pkey;
+ALTER TABLE album_genres DROP COLUMN album_id;
+ALTER TABLE album_genres ADD PRIMARY KEY (album_sk, genre_id);
+ALTER TABLE album_genres ADD FOREIGN KEY (album_sk) REFERENCES albums(sk);
+
+ALTER TABLE artist_genres ADD COLUMN artist_sk INTEGER;
+UPDATE artist_genres SET artist_sk = artists.sk
+FROM artists WHERE artists.id = artist_genres.artist_id;
+ALTER TABLE artist_genres DROP CONSTRAINT artist_genres_pkey;
+ALTER TABLE artist_genres DROP COLUMN artist_id;
+ALTER TABLE artist_genres ADD PRIMARY KEY (artist_sk, genre_id);
+ALTER TABLE artist_genres ADD FOREIGN KEY (artist_sk) REFERENCES artists(sk);
\ No newline at end of file
@@ -0,0 +1,136 @@
+-- Same as migrate_surrogate_keys.sql, comments about what it does are there.
+-- sqlite can't change primary keys, so every table is copied into a new one
+-- with the surrogate keys and then swapped with the old one.
+
+PRAGMA foreign_keys = OFF;
+
+BEGIN;
+
+-- Step 1: Catalog tables, the surrogate keys are generated while copying
+CREATE TABLE artists_new (
+    sk INTEGER PRIMARY KEY AUTOINCREMENT,
+    id VARCHAR(255) UNIQUE NOT NULL,
+    name VARCHAR(255) NOT NULL,
+    popularity INTEGER,
+    followers INTEGER,
+    image_sm TEXT,
+    image_md TEXT,
+    image_lg TEXT
+);
+INSERT INTO artists_new (id, name, popularity, followers, image_sm, image_md, image_lg)
+SELECT id, name, popularity, followers, image_sm, image_md, image_lg FROM artists;
+
+CREATE TABLE albums_new (
+    sk INTEGER PRIMARY KEY AUTOINCREMENT,
+    id VARCHAR(255) UNIQUE NOT NULL,
+    name VARCHAR(255) NOT NULL,
+    label VARCHAR(255),
+    popularity INTEGER,
+    release_date DATE,
+    total_tracks INTEGER,
+    image_sm TEXT,
+    image_md TEXT,
+    image_lg TEXT,
+    main_artist_id VARCHAR(255) REFERENCES artists(id)
+);
+INSERT INTO albums_new (id, name, label, popularity, release_date, total_tracks, image_sm, image_md, image_lg, main_artist_id)
+SELECT id, name, label, popularity, release_date, total_tracks, image_sm, image_md, image_lg, main_artist_id FROM albums;
+
+CREATE TABLE tracks_new (
+    sk INTEGER PRIMARY KEY AUTOINCREMENT,
+    id VARCHAR(255) UNIQUE NOT NULL,
+    name VARCHAR(255) NOT NULL,
+    disc_number INTEGER,
+    duration INTEGER,
+    is_explicit BOOLEAN,
+    popularity INTEGER,
+    track_number INTEGER,
+    is_local BOOLEAN,
+    album_id VARCHAR(255) REFERENCES albums(id),
+    main_artist_id VARCHAR(255) REFERENCES artists(id)
+);
+INSERT INTO tracks_new (id, name, disc_number, duration, is_explicit, popularity, track_number, is_local, album_id, main_artist_id)
+SELECT id, name, disc_number, duration, is_explicit, popularity, track_number, is_local, album_id, main_artist_id FROM tracks;
+
+-- Step 2: Streaming history
+CREATE TABLE streaming_history_new (
+    played_at TIMESTAMP NOT NULL,
+    ms_played INTEGER,
+    track_sk INTEGER NOT NULL REFERENCES tracks(sk),
+    context TEXT,
+    reason_start TEXT,
+    reason_end TEXT,
+    skipped BOOLEAN,
+    shuffle BOOLEAN,
+    PRIMARY KEY (played_at, track_sk)
+);
+INSERT INTO streaming_history_new (played_at, ms_played, track_sk, context, reason_start, reason_end, skipped, shuffle)
+SELECT sh.played_at, sh.ms_played, t.sk, sh.context, sh.reason_start, sh.reason_end, sh.skipped, sh.shuffle
+FROM streaming_history sh
+JOIN tracks_new t ON t.id = sh.track_id;
+
+-- Step 3: Associations
+CREATE TABLE album_artists_new (
+    album_sk INTEGER REFERENCES albums(sk),
+    artist_sk INTEGER REFERENCES artists(sk),
+    PRIMARY KEY (album_sk, artist_sk)
+);
+INSERT INTO album_artists_new (album_sk, artist_sk)
+SELECT al.sk, ar.sk
+FROM album_artists aa
+JOIN albums_new al ON al.id = aa.album_id
+JOIN artists_new ar ON ar.id = aa.artist_id;
+
+CREATE TABLE track_artists_new (
+    track_sk INTEGER REFERENCES tracks(sk),
+    artist_sk INTEGER REFERENCES artists(sk),
+    PRIMARY KEY (track_sk, artist_sk)
+);
+INSERT INTO track_artists_new (track_sk, artist_sk)
+SELECT t.sk, ar.sk
+FROM track_artists ta
+JOIN tracks_new t ON t.id = ta.track_id
+JOIN artists_new ar ON ar.id = ta.artist_id;
+
+CREATE TABLE album_genres_new (
+    album_sk INTEGER REFERENCES albums(sk),
+    genre_id INT REFERENCES genres(id),
+    PRIMARY KEY (album_sk, genre_id)
+);
+INSERT INTO album_genres_new (album_sk, genre_id)
+SELECT al.sk, ag.genre_id
+FROM album_genres ag
+JOIN albums_new al ON al.id = ag.album_id;
+
+CREATE TABLE artist_genres_new (
+    artist_sk INTEGER REFERENCES artists(sk),
+    genre_id INT REFERENCES genres(id),
+    PRIMARY KEY (artist_sk, genre_id)
+);
+INSERT INTO artist_genres_new (artist_sk, genre_id)
+SELECT ar.sk, ag.genre_id
+FROM artist_genres ag
+JOIN artists_new ar ON ar.id = ag.artist_id;
+
+-- Step 4: Swap the tables
+DROP TABLE streaming_history;
+DROP TABLE album_artists;
+DROP TABLE track_artists;
+DROP TABLE album_genres;
+DROP TABLE artist_genres;
+DROP TABLE tracks;
+DROP TABLE albums;
+DROP TABLE artists;
+
+ALTER TABLE artists_new RENAME TO artists;
+ALTER TABLE albums_new RENAME TO albums;
+ALTER TABLE tracks_new RENAME TO tracks;
+ALTER TABLE streaming_history_new RENAME TO streaming_history;
+ALTER TABLE album_artists_new RENAME TO album_artists;
+ALTER TABLE track_artists_new RENAME TO track_artists;
+ALTER TABLE album_genres_new RENAME TO album_genres;
+ALTER TABLE artist_genres_new RENAME TO artist_genres;
+
+COMMIT;
+
+PRAGMA foreign_keys = ON;
\ No newline at end of file
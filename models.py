@@ -1,5 +1,54 @@
-from db import query_db
-from typing import Optional, Union
+from db import query_db, query_db_many, get_columns
+from datetime import datetime
+from typing import Optional, Union, List, Dict, Any, Set, Tuple
+
+# Spotify id -> surrogate key of artists, albums and tracks. Keys never change
+# once a row is inserted, so they are cached for the whole process.
+_sk_cache = {"artists": {}, "albums": {}, "tracks": {}}
+
+
+def get_sk(table: str, id: str) -> Optional[int]:
+    """
+    Get the surrogate key of an artist, album or track from its Spotify id
+    """
+    cache = _sk_cache[table]
+    if id not in cache:
+        query = f"""
+        SELECT sk FROM {table} WHERE id = %s
+        """
+        result = query_db(query, (id,), fetchall=True)
+        if not result:
+            return None
+        cache[id] = result[0][0]
+    return cache[id]
+
+
+def require_sk(table: str, id: str) -> int:
+    """
+    Same as get_sk, but raises if the object is not in the database.
+    """
+    sk = get_sk(table, id)
+    if sk is None:
+        raise ValueError(f"{id} is not in {table}")
+    return sk
+
+
+def load_sks(table: str, ids: List[str]) -> None:
+    """
+    Caches the surrogate keys of many artists, albums or tracks with a single query
+    """
+    ids = [id for id in ids if id not in _sk_cache[table]]
+    if not ids:
+        return
+
+    values = ", ".join(["(%s)"] * len(ids))
+    query = f"""
+        SELECT {table}.id, {table}.sk
+        FROM (VALUES {values}) AS t
+        JOIN {table} ON {table}.id = t.column1
+    """
+    result = query_db(query, tuple(ids), fetchall=True)
+    _sk_cache[table].update(dict(result))
 
 
 def insert_artist(
@@ -107,11 +156,15 @@ def insert_album_artist(album_id: str, artist_id: str):
     Inserts an artist association for an album into the database.
     """
     query = """
-    INSERT INTO album_artists (album_id, artist_id)
+    INSERT INTO album_artists (album_sk, artist_sk)
     VALUES (%s, %s)
-    ON CONFLICT (album_id, artist_id) DO NOTHING
+    ON CONFLICT (album_sk, artist_sk) DO NOTHING
     """
-    query_db(query, (album_id, artist_id), commit=True)
+    query_db(
+        query,
+        (require_sk("albums", album_id), require_sk("artists", artist_id)),
+        commit=True,
+    )
 
 
 def insert_track_artist(track_id: str, artist_id: str):
@@ -119,11 +172,15 @@ def insert_track_artist(track_id: str, artist_id: str):
     Inserts an artist association for a track into the database.
     """
     query = """
-    INSERT INTO track_artists (track_id, artist_id)
+    INSERT INTO track_artists (track_sk, artist_sk)
     VALUES (%s, %s)
-    ON CONFLICT (track_id, artist_id) DO NOTHING
+    ON CONFLICT (track_sk, artist_sk) DO NOTHING
     """
-    query_db(query, (track_id, artist_id), commit=True)
+    query_db(
+        query,
+        (require_sk("tracks", track_id), require_sk("artists", artist_id)),
+        commit=True,
+    )
 
 
 def insert_streaming_history(
@@ -141,16 +198,16 @@ def insert_streaming_history(
     """
     query = """
     INSERT INTO
-        streaming_history (played_at, ms_played, track_id, context, reason_start, reason_end, skipped, shuffle)
+        streaming_history (played_at, ms_played, track_sk, context, reason_start, reason_end, skipped, shuffle)
     VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-    ON CONFLICT (played_at, track_id) DO NOTHING
+    ON CONFLICT (played_at, track_sk) DO NOTHING
     """
     query_db(
         query,
         (
             played_at,
             ms_played,
-            track_id,
+            require_sk("tracks", track_id),
             context,
             reason_start,
             reason_end,
@@ -180,11 +237,11 @@ def insert_artist_genre(artist_id: str, genre_id: int):
     Inserts a genre association for an artist into the database.
     """
     query = """
-    INSERT INTO artist_genres (artist_id, genre_id)
+    INSERT INTO artist_genres (artist_sk, genre_id)
     VALUES (%s, %s)
-    ON CONFLICT (artist_id, genre_id) DO NOTHING
+    ON CONFLICT (artist_sk, genre_id) DO NOTHING
     """
-    query_db(query, (artist_id, genre_id), commit=True)
+    query_db(query, (require_sk("artists", artist_id), genre_id), commit=True)
 
 
 def insert_album_genre(album_id: str, genre_id: int):
@@ -192,11 +249,11 @@ def insert_album_genre(album_id: str, genre_id: int):
     Inserts a genre association for an album into the database.
     """
     query = """
-    INSERT INTO album_genres (album_id, genre_id)
+    INSERT INTO album_genres (album_sk, genre_id)
     VALUES (%s, %s)
-    ON CONFLICT (album_id, genre_id) DO NOTHING
+    ON CONFLICT (album_sk, genre_id) DO NOTHING
     """
-    query_db(query, (album_id, genre_id), commit=True)
+    query_db(query, (require_sk("albums", album_id), genre_id), commit=True)
 
 
 def get_object_by_id(id: str, table: str) -> Union[str, int, None]:
@@ -225,10 +282,14 @@ def is_streaming_history_added(played_at: str, track_id: str) -> bool:
     """
     Check if a streaming history record is already added
     """
+    track_sk = get_sk("tracks", track_id)
+    if track_sk is None:
+        return False
+
     query = """
-    SELECT played_at FROM streaming_history WHERE played_at = %s AND track_id = %s
+    SELECT played_at FROM streaming_history WHERE played_at = %s AND track_sk = %s
     """
-    result = query_db(query, (played_at, track_id), fetchall=True)
+    result = query_db(query, (played_at, track_sk), fetchall=True)
     return bool(result)
 
 
@@ -236,12 +297,522 @@ def get_new_ids(table: str, ids: list) -> list:
     """
     From a list of IDs, return the ones that are not in the database
     """
+    if not ids:
+        return []
+
+    # VALUES columns are named column1, column2... both in postgres and sqlite
+    values = ", ".join(["(%s)"] * len(ids))
     query = f"""
-        SELECT t.id
-        FROM unnest(%s::text[]) AS t(id)
-        LEFT JOIN {table} ON {table}.id = t.id
+        SELECT t.column1
+        FROM (VALUES {values}) AS t
+        LEFT JOIN {table} ON {table}.id = t.column1
         WHERE {table}.id IS NULL
     """
-    result = query_db(query, (ids,), fetchall=True)
+    result = query_db(query, tuple(ids), fetchall=True)
     results = [r[0] for r in result]
     return results
+
+
+def insert_failed_streaming_history(
+    played_at: str,
+    ms_played: int,
+    track_id: str,
+    context: Optional[str],
+    reason_start: Optional[str],
+    reason_end: Optional[str],
+    skipped: Optional[bool],
+    shuffle: Optional[bool],
+    failure_reason: str,
+    next_attempt_at: datetime,
+):
+    """
+    Inserts a streaming history record that failed to be added into the
+    dead-letter table, so it can be retried later.
+    """
+    query = """
+    INSERT INTO
+        failed_streaming_history (played_at, ms_played, track_id, context, reason_start, reason_end, skipped, shuffle, failure_reason, next_attempt_at)
+    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+    ON CONFLICT (played_at, track_id) DO NOTHING
+    """
+    query_db(
+        query,
+        (
+            played_at,
+            ms_played,
+            track_id,
+            context,
+            reason_start,
+            reason_end,
+            skipped,
+            shuffle,
+            failure_reason,
+            next_attempt_at,
+        ),
+        commit=True,
+    )
+
+
+def update_failed_streaming_history(
+    played_at: datetime,
+    track_id: str,
+    failure_reason: str,
+    attempts: int,
+    status: str,
+    last_attempt_at: datetime,
+    next_attempt_at: datetime,
+):
+    """
+    Updates the retry state of a failed streaming history record.
+    """
+    query = """
+    UPDATE failed_streaming_history
+    SET failure_reason = %s, attempts = %s, status = %s, last_attempt_at = %s, next_attempt_at = %s
+    WHERE played_at = %s AND track_id = %s
+    """
+    query_db(
+        query,
+        (
+            failure_reason,
+            attempts,
+            status,
+            last_attempt_at,
+            next_attempt_at,
+            played_at,
+            track_id,
+        ),
+        commit=True,
+    )
+
+
+def delete_failed_streaming_history(played_at: datetime, track_id: str):
+    """
+    Removes a streaming history record from the dead-letter table.
+    """
+    query = """
+    DELETE FROM failed_streaming_history WHERE played_at = %s AND track_id = %s
+    """
+    query_db(query, (played_at, track_id), commit=True)
+
+
+def get_due_failed_streaming_history(now: datetime) -> List[Dict[str, Any]]:
+    """
+    Get all pending failed streaming history records that are due for a retry
+    """
+    query = """
+    SELECT played_at, ms_played, track_id, context, reason_start, reason_end, skipped, shuffle, attempts
+    FROM failed_streaming_history
+    WHERE status = 'pending' AND next_attempt_at <= %s
+    ORDER BY played_at
+    """
+    result = query_db(query, (now,), fetchall=True)
+    columns = (
+        "played_at",
+        "ms_played",
+        "track_id",
+        "context",
+        "reason_start",
+        "reason_end",
+        "skipped",
+        "shuffle",
+        "attempts",
+    )
+    return [dict(zip(columns, r)) for r in result]
+
+
+def get_failed_streaming_history_keys() -> Set[Tuple[datetime, str]]:
+    """
+    Get the (played_at, track_id) of every record in the dead-letter table
+    """
+    query = """
+    SELECT played_at, track_id FROM failed_streaming_history
+    """
+    result = query_db(query, fetchall=True)
+    return {(r[0], r[1]) for r in result}
+
+
+def count_new_streaming_history(
+    played_ats: List[datetime], track_ids: List[str]
+) -> int:
+    """
+    From lists of played_at and track_id, count the records that are not in
+    the database
+    """
+    if not played_ats:
+        return 0
+
+    values = ", ".join(["(%s, %s)"] * len(played_ats))
+    query = f"""
+        SELECT COUNT(*)
+        FROM (VALUES {values}) AS t
+        LEFT JOIN tracks ON tracks.id = t.column2
+        LEFT JOIN streaming_history sh
+            ON sh.played_at = t.column1 AND sh.track_sk = tracks.sk
+        WHERE sh.track_sk IS NULL
+    """
+    params = tuple(p for row in zip(played_ats, track_ids) for p in row)
+    result = query_db(query, params, fetchall=True)
+    return result[0][0]
+
+
+def needs_surrogate_keys_migration() -> bool:
+    """
+    Check if the database was created before surrogate keys existed
+    """
+    columns = get_columns("tracks")
+    # No columns means a new database, the schema creates it with surrogate keys
+    return bool(columns) and "sk" not in columns
+
+
+def get_table_count(table: str) -> int:
+    """
+    Get the number of rows in a table
+    """
+    query = f"""
+    SELECT COUNT(*) FROM {table}
+    """
+    result = query_db(query, fetchall=True)
+    return result[0][0]
+
+
+def get_played_albums_per_track() -> Optional[float]:
+    """
+    Get the average number of distinct albums per distinct track that was
+    played. Returns None if there is no streaming history yet.
+    """
+    query = """
+    SELECT COUNT(DISTINCT tracks.album_id) * 1.0 / NULLIF(COUNT(DISTINCT tracks.id), 0)
+    FROM streaming_history
+    JOIN tracks ON tracks.sk = streaming_history.track_sk
+    """
+    result = query_db(query, fetchall=True)
+    return float(result[0][0]) if result and result[0][0] is not None else None
+
+
+def insert_imported_file(
+    content_hash: str,
+    filename: str,
+    size: int,
+    mtime: float,
+    row_count: int,
+    imported_at: datetime,
+):
+    """
+    Records an extended history file as fully imported.
+    """
+    query = """
+    INSERT INTO imported_files (content_hash, filename, size, mtime, row_count, imported_at)
+    VALUES (%s, %s, %s, %s, %s, %s)
+    ON CONFLICT (content_hash) DO NOTHING
+    """
+    query_db(
+        query,
+        (content_hash, filename, size, mtime, row_count, imported_at),
+        commit=True,
+    )
+
+
+def insert_imported_file_alias(
+    content_hash: str, filename: str, size: int, mtime: float
+):
+    """
+    Records another name, size and modification time of an already imported file.
+    """
+    query = """
+    INSERT INTO imported_file_aliases (filename, size, mtime, content_hash)
+    VALUES (%s, %s, %s, %s)
+    ON CONFLICT (filename, size, mtime) DO UPDATE SET content_hash = excluded.content_hash
+    """
+    query_db(query, (filename, size, mtime, content_hash), commit=True)
+
+
+def get_imported_files() -> List[Dict[str, Any]]:
+    """
+    Get all extended history files that were already imported, once for
+    every name they were seen under
+    """
+    query = """
+    SELECT content_hash, filename, size, mtime FROM imported_files
+    UNION ALL
+    SELECT content_hash, filename, size, mtime FROM imported_file_aliases
+    """
+    result = query_db(query, fetchall=True)
+    columns = ("content_hash", "filename", "size", "mtime")
+    return [dict(zip(columns, r)) for r in result]
+
+
+def get_top_tracks(since: datetime, limit: int) -> List[Dict[str, Any]]:
+    """
+    Get the most played tracks since a date
+    """
+    query = """
+    SELECT tracks.id, tracks.name, artists.name, COUNT(*) AS plays, SUM(streaming_history.ms_played)
+    FROM streaming_history
+    JOIN tracks ON tracks.sk = streaming_history.track_sk
+    LEFT JOIN artists ON artists.id = tracks.main_artist_id
+    WHERE streaming_history.played_at >= %s
+    GROUP BY tracks.id, tracks.name, artists.name
+    ORDER BY plays DESC, tracks.name
+    LIMIT %s
+    """
+    result = query_db(query, (since, limit), fetchall=True)
+    columns = ("track_id", "name", "artist", "plays", "ms_played")
+    return [dict(zip(columns, r)) for r in result]
+
+
+def get_top_artists(since: datetime, limit: int) -> List[Dict[str, Any]]:
+    """
+    Get the most played artists since a date, counting every artist of a track
+    """
+    query = """
+    SELECT artists.id, artists.name, COUNT(*) AS plays, SUM(streaming_history.ms_played)
+    FROM streaming_history
+    JOIN track_artists ON track_artists.track_sk = streaming_history.track_sk
+    JOIN artists ON artists.sk = track_artists.artist_sk
+    WHERE streaming_history.played_at >= %s
+    GROUP BY artists.id, artists.name
+    ORDER BY plays DESC, artists.name
+    LIMIT %s
+    """
+    result = query_db(query, (since, limit), fetchall=True)
+    columns = ("artist_id", "name", "plays", "ms_played")
+    return [dict(zip(columns, r)) for r in result]
+
+
+def get_top_genres(since: datetime, limit: int) -> List[Dict[str, Any]]:
+    """
+    Get the most played genres since a date, based on the main artist of each track
+    """
+    query = """
+    SELECT genres.name, COUNT(*) AS plays, SUM(streaming_history.ms_played)
+    FROM streaming_history
+    JOIN tracks ON tracks.sk = streaming_history.track_sk
+    JOIN artists ON artists.id = tracks.main_artist_id
+    JOIN artist_genres ON artist_genres.artist_sk = artists.sk
+    JOIN genres ON genres.id = artist_genres.genre_id
+    WHERE streaming_history.played_at >= %s
+    GROUP BY genres.name
+    ORDER BY plays DESC, genres.name
+    LIMIT %s
+    """
+    result = query_db(query, (since, limit), fetchall=True)
+    columns = ("genre", "plays", "ms_played")
+    return [dict(zip(columns, r)) for r in result]
+
+
+def get_plays_per_day(since: datetime) -> List[Dict[str, Any]]:
+    """
+    Get the number of plays and time played for each day since a date
+    """
+    query = """
+    SELECT DATE(played_at) AS day, COUNT(*), SUM(ms_played)
+    FROM streaming_history
+    WHERE played_at >= %s
+    GROUP BY DATE(played_at)
+    ORDER BY day
+    """
+    result = query_db(query, (since,), fetchall=True)
+    # Postgres returns a date and sqlite a string, both become YYYY-MM-DD
+    return [{"day": str(r[0]), "plays": r[1], "ms_played": r[2]} for r in result]
+
+
+def get_recent_plays(limit: int) -> List[Dict[str, Any]]:
+    """
+    Get the latest streaming history records with track and artist names
+    """
+    query = """
+    SELECT streaming_history.played_at, tracks.id, tracks.name, artists.name, streaming_history.ms_played, streaming_history.context
+    FROM streaming_history
+    JOIN tracks ON tracks.sk = streaming_history.track_sk
+    LEFT JOIN artists ON artists.id = tracks.main_artist_id
+    ORDER BY streaming_history.played_at DESC
+    LIMIT %s
+    """
+    result = query_db(query, (limit,), fetchall=True)
+    columns = ("played_at", "track_id", "name", "artist", "ms_played", "context")
+    return [dict(zip(columns, r)) for r in result]
+
+
+def bump_streaming_history_version():
+    """
+    Marks the streaming history as changed
+    """
+    query = """
+    INSERT INTO streaming_history_version (id, version) VALUES (1, 1)
+    ON CONFLICT (id) DO UPDATE SET version = streaming_history_version.version + 1
+    """
+    query_db(query, commit=True)
+
+
+def get_streaming_history_version() -> int:
+    """
+    Get the number of times the streaming history changed
+    """
+    query = """
+    SELECT version FROM streaming_history_version
+    """
+    result = query_db(query, fetchall=True)
+    return result[0][0] if result else 0
+
+
+def insert_track_audio_features(features: List[Dict[str, Any]]):
+    """
+    Inserts the audio features of many tracks into the database at once.
+    """
+    query = """
+    INSERT INTO
+        track_audio_features (track_id, danceability, energy, key, loudness, mode, speechiness, acousticness, instrumentalness, liveness, valence, tempo, time_signature, fetched_at)
+    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+    ON CONFLICT (track_id) DO NOTHING
+    """
+    now = datetime.now()
+    query_db_many(
+        query,
+        [
+            (
+                f["track_id"],
+                f["danceability"],
+                f["energy"],
+                f["key"],
+                f["loudness"],
+                f["mode"],
+                f["speechiness"],
+                f["acousticness"],
+                f["instrumentalness"],
+                f["liveness"],
+                f["valence"],
+                f["tempo"],
+                f["time_signature"],
+                now,
+            )
+            for f in features
+        ],
+    )
+
+
+def update_track_popularity(popularity: List[Tuple[str, int]]):
+    """
+    Updates the popularity of many tracks at once, from (track_id, popularity) pairs.
+    """
+    query = """
+    UPDATE tracks SET popularity = %s WHERE id = %s
+    """
+    query_db_many(query, [(p, track_id) for track_id, p in popularity])
+
+
+def insert_track_enrichment_attempts(track_ids: List[str], kind: str):
+    """
+    Records that requesting the audio features or popularity ("kind") of many
+    tracks returned nothing or failed.
+    """
+    query = """
+    INSERT INTO track_enrichment_attempts (track_id, kind, attempted_at)
+    VALUES (%s, %s, %s)
+    ON CONFLICT (track_id, kind) DO UPDATE SET attempted_at = excluded.attempted_at
+    """
+    now = datetime.now()
+    query_db_many(query, [(track_id, kind, now) for track_id in track_ids])
+
+
+def get_tracks_without_audio_features(retry_before: datetime) -> List[str]:
+    """
+    Get the IDs of all tracks whose audio features were not requested yet,
+    or whose last failed attempt was before retry_before
+    """
+    query = """
+    SELECT tracks.id
+    FROM tracks
+    LEFT JOIN track_audio_features ON track_audio_features.track_id = tracks.id
+    LEFT JOIN track_enrichment_attempts
+        ON track_enrichment_attempts.track_id = tracks.id
+        AND track_enrichment_attempts.kind = 'audio_features'
+    WHERE track_audio_features.track_id IS NULL AND tracks.is_local IS NOT TRUE
+    AND (track_enrichment_attempts.attempted_at IS NULL OR track_enrichment_attempts.attempted_at < %s)
+    """
+    result = query_db(query, (retry_before,), fetchall=True)
+    return [r[0] for r in result]
+
+
+def get_tracks_without_popularity(retry_before: datetime) -> List[str]:
+    """
+    Get the IDs of all tracks that have no popularity, and were not requested
+    yet or whose last failed attempt was before retry_before
+    """
+    query = """
+    SELECT tracks.id
+    FROM tracks
+    LEFT JOIN track_enrichment_attempts
+        ON track_enrichment_attempts.track_id = tracks.id
+        AND track_enrichment_attempts.kind = 'popularity'
+    WHERE tracks.popularity IS NULL AND tracks.is_local IS NOT TRUE
+    AND (track_enrichment_attempts.attempted_at IS NULL OR track_enrichment_attempts.attempted_at < %s)
+    """
+    result = query_db(query, (retry_before,), fetchall=True)
+    return [r[0] for r in result]
+
+
+def get_plays_between(start: datetime, end: datetime) -> List[Dict[str, Any]]:
+    """
+    Get all streaming history records played between two dates, in order
+    """
+    query = """
+    SELECT streaming_history.played_at, streaming_history.ms_played, tracks.id, streaming_history.skipped
+    FROM streaming_history
+    JOIN tracks ON tracks.sk = streaming_history.track_sk
+    WHERE streaming_history.played_at >= %s AND streaming_history.played_at <= %s
+    ORDER BY streaming_history.played_at
+    """
+    result = query_db(query, (start, end), fetchall=True)
+    columns = ("played_at", "ms_played", "track_id", "skipped")
+    return [dict(zip(columns, r)) for r in result]
+
+
+def get_listening_sessions_between(
+    start: datetime, end: datetime
+) -> List[Dict[str, Any]]:
+    """
+    Get all listening sessions that overlap the period between two dates
+    """
+    query = """
+    SELECT started_at, ended_at
+    FROM listening_sessions
+    WHERE ended_at >= %s AND started_at <= %s
+    """
+    result = query_db(query, (start, end), fetchall=True)
+    return [{"started_at": r[0], "ended_at": r[1]} for r in result]
+
+
+def delete_listening_sessions(start: datetime, end: datetime, commit: bool = True):
+    """
+    Deletes all listening sessions that started between two dates
+    """
+    query = """
+    DELETE FROM listening_sessions WHERE started_at >= %s AND started_at <= %s
+    """
+    query_db(query, (start, end), commit=commit)
+
+
+def insert_listening_sessions(sessions: List[Dict[str, Any]]):
+    """
+    Inserts many listening sessions into the database at once.
+    """
+    query = """
+    INSERT INTO
+        listening_sessions (started_at, ended_at, plays, ms_played, skips, first_track_id, last_track_id)
+    VALUES (%s, %s, %s, %s, %s, %s, %s)
+    """
+    query_db_many(
+        query,
+        [
+            (
+                s["started_at"],
+                s["ended_at"],
+                s["plays"],
+                s["ms_played"],
+                s["skips"],
+                s["first_track_id"],
+                s["last_track_id"],
+            )
+            for s in sessions
+        ],
+    )
@@ -0,0 +1,110 @@
+from datetime import datetime
+from typing import List, Dict, Any
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+TRACK_URI_PREFIX = "spotify:track:"
+
+
+def normalize_extended_history(items: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Cleans the raw rows from the extended streaming history export.
+
+    Parses 'ts' into a datetime truncated to seconds, strips the
+    'spotify:track:' prefix from the track URI, drops everything that is
+    not a track (podcasts, videos, etc.) and removes duplicated
+    (played_at, track_id) pairs.
+
+    Returns a list of dictionaries sorted by (played_at, track_id) with the
+    keys played_at, ms_played, track_id, reason_start, reason_end, skipped
+    and shuffle.
+
+    Uses NumPy to do it all in one vectorized pass when it is installed,
+    otherwise falls back to plain Python.
+    """
+    if not items:
+        return []
+
+    if np is None:
+        return _normalize_python(items)
+    return _normalize_numpy(items)
+
+
+def _build_row(item: Dict[str, Any], played_at: datetime, track_id: str):
+    return {
+        "played_at": played_at,
+        "ms_played": item.get("ms_played"),
+        "track_id": track_id,
+        "reason_start": item.get("reason_start"),
+        "reason_end": item.get("reason_end"),
+        "skipped": item.get("skipped"),
+        "shuffle": item.get("shuffle"),
+    }
+
+
+def _normalize_numpy(items: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    uris = np.array([item.get("spotify_track_uri") or "" for item in items])
+    # Missing timestamps become NaT and are masked out below. The trailing
+    # 'Z' is removed since numpy doesn't parse timezone designators.
+    timestamps = np.array([item.get("ts") or "NaT" for item in items])
+    timestamps = np.char.rstrip(timestamps, "Z")
+
+    # Parse with microsecond precision first, casting straight to seconds
+    # would fail for strings that carry a fractional part.
+    played_at = timestamps.astype("datetime64[us]").astype("datetime64[s]")
+
+    # Podcasts and videos have no track URI
+    mask = np.char.startswith(uris, TRACK_URI_PREFIX) & ~np.isnat(played_at)
+    indexes = np.flatnonzero(mask)
+    # np.char fails on empty arrays with numpy 2, e.g. for podcast only files
+    if indexes.size == 0:
+        return []
+    track_ids = np.char.replace(uris[indexes], TRACK_URI_PREFIX, "")
+    played_at = played_at[indexes]
+
+    # Sort by (played_at, track_id), lexsort uses the last key as primary
+    order = np.lexsort((track_ids, played_at))
+    indexes, track_ids, played_at = indexes[order], track_ids[order], played_at[order]
+
+    # After sorting duplicates are next to each other, keep only the first
+    unique = np.ones(len(indexes), dtype=bool)
+    unique[1:] = (played_at[1:] != played_at[:-1]) | (track_ids[1:] != track_ids[:-1])
+
+    return [
+        _build_row(items[i], ts, track_id)
+        for i, ts, track_id in zip(
+            indexes[unique].tolist(),
+            played_at[unique].tolist(),
+            track_ids[unique].tolist(),
+        )
+    ]
+
+
+def _parse_ts(ts: str) -> datetime:
+    """
+    Parses a timestamp such as '2021-01-01T12:34:56Z' and truncates it to seconds.
+    """
+    ts = ts.rstrip("Z")
+    return datetime.fromisoformat(ts).replace(microsecond=0)
+
+
+def _normalize_python(items: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    rows = {}
+
+    for item in items:
+        uri = item.get("spotify_track_uri") or ""
+        if not uri.startswith(TRACK_URI_PREFIX) or not item.get("ts"):
+            continue
+
+        track_id = uri[len(TRACK_URI_PREFIX) :]
+        played_at = _parse_ts(item.get("ts"))
+        # Keep only the first occurrence, same as the numpy version
+        rows.setdefault((played_at, track_id), item)
+
+    return [
+        _build_row(item, played_at, track_id)
+        for (played_at, track_id), item in sorted(rows.items(), key=lambda x: x[0])
+    ]
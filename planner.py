@@ -0,0 +1,155 @@
+import math
+from datetime import datetime
+from typing import List, Dict, Any
+from logger import logger
+from helpers import (
+    batch_generator,
+    SPOTIFY_REQUESTS_PER_SECOND,
+    ENRICHMENT_RETRY_DELAY,
+)
+from models import (
+    get_new_ids,
+    count_new_streaming_history,
+    get_table_count,
+    get_played_albums_per_track,
+    get_tracks_without_audio_features,
+    get_tracks_without_popularity,
+)
+
+# These mirror how add_extended_history and the flows request data.
+# New tracks are sent to the flow 50 at a time, followed by a 3 seconds
+# sleep. Albums are requested 20 at a time and the artists of each album
+# batch 50 at a time.
+TRACKS_PER_FLUSH = 50
+SLEEP_PER_FLUSH = 3
+TRACKS_BATCH_SIZE = 50
+ALBUMS_BATCH_SIZE = 20
+ARTISTS_BATCH_SIZE = 50
+
+# After the import every track without them gets its audio features and
+# popularity, which includes all tracks of the new albums, not only the
+# played ones.
+AUDIO_FEATURES_BATCH_SIZE = 100
+POPULARITY_BATCH_SIZE = 50
+
+# Size of the batches used to diff the export against the database
+LOOKUP_BATCH_SIZE = 10000
+
+
+def plan_extended_history(extended_history: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Estimates what adding the (normalized) extended history would do,
+    without making any request to Spotify or writing to the database.
+
+    Tracks and plays are exact, they are diffed against the database.
+    Albums, artists and the tracks of new albums can't be known without
+    asking Spotify, so they are estimated from the ratios of what is already
+    in the database. When the database is empty the worst case of one new
+    album per track is assumed.
+    """
+    track_ids = list({item["track_id"] for item in extended_history})
+
+    new_track_ids = []
+    for batch in batch_generator(track_ids, LOOKUP_BATCH_SIZE):
+        new_track_ids.extend(get_new_ids("tracks", batch))
+
+    new_plays = 0
+    for batch in batch_generator(extended_history, LOOKUP_BATCH_SIZE):
+        new_plays += count_new_streaming_history(
+            [item["played_at"] for item in batch],
+            [item["track_id"] for item in batch],
+        )
+
+    albums_per_track = get_played_albums_per_track() or 1.0
+    albums_count = get_table_count("albums")
+    artists_per_album = (
+        get_table_count("artists") / albums_count if albums_count else 1.0
+    )
+    tracks_per_album = get_table_count("tracks") / albums_count if albums_count else 1.0
+
+    new_tracks = len(new_track_ids)
+    new_albums = math.ceil(new_tracks * albums_per_track)
+    new_artists = math.ceil(new_albums * artists_per_album)
+    inserted_tracks = max(new_tracks, math.ceil(new_albums * tracks_per_album))
+
+    # Tracks already in the database that are still waiting to be enriched
+    retry_before = datetime.now() - ENRICHMENT_RETRY_DELAY
+    audio_features_tracks = inserted_tracks + len(
+        get_tracks_without_audio_features(retry_before)
+    )
+    popularity_tracks = inserted_tracks + len(
+        get_tracks_without_popularity(retry_before)
+    )
+
+    # Every flush requests its tracks, then their albums, then all artists
+    # of each album batch, even the ones that are already in the database.
+    # All flushes are full except the last one.
+    flushes = math.ceil(new_tracks / TRACKS_PER_FLUSH)
+    album_requests = 0
+    artist_requests = 0
+    for flush in range(flushes):
+        flush_tracks = min(TRACKS_PER_FLUSH, new_tracks - flush * TRACKS_PER_FLUSH)
+        flush_albums = min(math.ceil(flush_tracks * albums_per_track), flush_tracks)
+        for batch in range(math.ceil(flush_albums / ALBUMS_BATCH_SIZE)):
+            batch_albums = min(
+                ALBUMS_BATCH_SIZE, flush_albums - batch * ALBUMS_BATCH_SIZE
+            )
+            album_requests += 1
+            artist_requests += math.ceil(
+                batch_albums * artists_per_album / ARTISTS_BATCH_SIZE
+            )
+
+    requests = {
+        "tracks": {"batch_size": TRACKS_BATCH_SIZE, "requests": flushes},
+        "albums": {"batch_size": ALBUMS_BATCH_SIZE, "requests": album_requests},
+        "artists": {"batch_size": ARTISTS_BATCH_SIZE, "requests": artist_requests},
+        "audio features": {
+            "batch_size": AUDIO_FEATURES_BATCH_SIZE,
+            "requests": math.ceil(audio_features_tracks / AUDIO_FEATURES_BATCH_SIZE),
+        },
+        "popularity": {
+            "batch_size": POPULARITY_BATCH_SIZE,
+            "requests": math.ceil(popularity_tracks / POPULARITY_BATCH_SIZE),
+        },
+    }
+    total_requests = sum(r["requests"] for r in requests.values())
+
+    return {
+        "plays": len(extended_history),
+        "new_plays": new_plays,
+        "tracks": len(track_ids),
+        "new_tracks": new_tracks,
+        "new_albums": new_albums,
+        "new_artists": new_artists,
+        "inserted_tracks": inserted_tracks,
+        "requests": requests,
+        "total_requests": total_requests,
+        "requests_per_second": SPOTIFY_REQUESTS_PER_SECOND,
+        "estimated_seconds": total_requests / SPOTIFY_REQUESTS_PER_SECOND
+        + flushes * SLEEP_PER_FLUSH,
+    }
+
+
+def log_plan(plan: Dict[str, Any]) -> None:
+    """
+    Logs a human readable version of an import plan.
+    """
+    hours, rest = divmod(int(plan["estimated_seconds"]), 3600)
+    minutes, seconds = divmod(rest, 60)
+
+    logger.info(f"Plays: {plan['new_plays']} new out of {plan['plays']}")
+    logger.info(f"Tracks: {plan['new_tracks']} new out of {plan['tracks']}")
+    logger.info(f"Albums: ~{plan['new_albums']} new (estimated)")
+    logger.info(f"Artists: ~{plan['new_artists']} new (estimated)")
+    logger.info(
+        f"Tracks inserted from the new albums: ~{plan['inserted_tracks']} (estimated)"
+    )
+    for endpoint, request in plan["requests"].items():
+        logger.info(
+            f"Requests for {endpoint}: ~{request['requests']} (batches of {request['batch_size']})"
+        )
+    logger.info(
+        f"Total requests: ~{plan['total_requests']}, "
+        f"estimated time at {plan['requests_per_second']} requests per second: "
+        f"{hours}h {minutes}m {seconds}s"
+    )
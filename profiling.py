@@ -0,0 +1,76 @@
+import os
+import io
+import cProfile
+import pstats
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime
+from logger import logger, dir_path
+
+# How many functions and allocation sites are listed in the summary
+TOP_N = 25
+
+_run_id = None
+
+
+def enable_profiling() -> None:
+    """
+    Turns on profiling for every phase wrapped with profile_phase.
+
+    Results are written next to spotify.log: one .prof file per phase, which
+    can be opened with snakeviz or pstats, and a text summary per run.
+    """
+    global _run_id
+    _run_id = datetime.now().strftime("%Y%m%d-%H%M%S")
+    tracemalloc.start()
+    logger.info(f"Profiling enabled, results will be saved in {dir_path}")
+
+
+@contextmanager
+def profile_phase(name: str):
+    """
+    Runs the block under cProfile and takes tracemalloc snapshots before and
+    after it. Does nothing if profiling is not enabled.
+    """
+    if _run_id is None:
+        yield
+        return
+
+    tracemalloc.reset_peak()
+    before = tracemalloc.take_snapshot()
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        after = tracemalloc.take_snapshot()
+        _, peak = tracemalloc.get_traced_memory()
+        _save_phase(name, profiler, before, after, peak)
+
+
+def _save_phase(name, profiler, before, after, peak):
+    prof_path = os.path.join(dir_path, f"profile_{_run_id}_{name}.prof")
+    profiler.dump_stats(prof_path)
+
+    stream = io.StringIO()
+    stats = pstats.Stats(profiler, stream=stream)
+    stats.sort_stats("cumulative").print_stats(TOP_N)
+
+    lines = [
+        f"===== {name} =====",
+        f"Total time: {stats.total_tt:.3f}s, peak memory: {peak / 1024 / 1024:.1f} MiB",
+        "",
+        stream.getvalue(),
+        f"Top {TOP_N} allocation differences:",
+    ]
+    for stat in after.compare_to(before, "lineno")[:TOP_N]:
+        lines.append(str(stat))
+
+    summary_path = os.path.join(dir_path, f"profile_{_run_id}.txt")
+    with open(summary_path, "a") as f:
+        f.write("\n".join(lines) + "\n\n")
+
+    logger.info(
+        f"Profiled {name} in {stats.total_tt:.3f}s, peak memory {peak / 1024 / 1024:.1f} MiB, saved to {prof_path}"
+    )
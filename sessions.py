@@ -0,0 +1,129 @@
+import os
+from datetime import datetime, timedelta
+from typing import List, Dict, Any, Tuple
+from logger import logger
+from models import (
+    get_plays_between,
+    get_listening_sessions_between,
+    delete_listening_sessions,
+    insert_listening_sessions,
+    get_table_count,
+)
+
+# A new session starts when nothing was played for longer than this
+SESSION_GAP = timedelta(minutes=float(os.getenv("SESSION_GAP_MINUTES") or 30))
+
+
+def _play_start(play: Dict[str, Any]) -> datetime:
+    # played_at is when the track stopped playing
+    return play["played_at"] - timedelta(milliseconds=play["ms_played"] or 0)
+
+
+def split_sessions(
+    plays: List[Dict[str, Any]], gap: timedelta = SESSION_GAP
+) -> List[Dict[str, Any]]:
+    """
+    Groups plays, sorted by played_at, into listening sessions.
+
+    A play belongs to the current session if it started at most `gap` after
+    the previous play ended.
+    """
+    sessions = []
+    session = None
+
+    for play in plays:
+        start = _play_start(play)
+        if session is None or start - session["ended_at"] > gap:
+            session = {
+                "started_at": start,
+                "ended_at": play["played_at"],
+                "plays": 0,
+                "ms_played": 0,
+                "skips": 0,
+                "first_track_id": play["track_id"],
+                "last_track_id": play["track_id"],
+            }
+            sessions.append(session)
+
+        session["started_at"] = min(session["started_at"], start)
+        session["ended_at"] = max(session["ended_at"], play["played_at"])
+        session["plays"] += 1
+        session["ms_played"] += play["ms_played"] or 0
+        session["skips"] += 1 if play["skipped"] else 0
+        session["last_track_id"] = play["track_id"]
+
+    return sessions
+
+
+def rebuild_listening_sessions() -> None:
+    """
+    Recomputes all listening sessions from the whole streaming history.
+    """
+    logger.info("Rebuilding all listening sessions")
+    plays = get_plays_between(datetime.min, datetime.max)
+    sessions = split_sessions(plays)
+
+    # Committed together with the insert
+    delete_listening_sessions(datetime.min, datetime.max, commit=False)
+    insert_listening_sessions(sessions)
+    logger.info(f"Built {len(sessions)} listening sessions from {len(plays)} plays")
+
+
+def _cluster_plays(
+    new_plays: List[Tuple[datetime, int]], gap: timedelta = SESSION_GAP
+) -> List[Tuple[datetime, datetime]]:
+    """
+    Groups plays, as (played_at, ms_played), into (start, end) windows that
+    are separated by more than `gap`.
+    """
+    windows = []
+    for start, end in sorted(
+        (played_at - timedelta(milliseconds=ms_played or 0), played_at)
+        for played_at, ms_played in new_plays
+    ):
+        if windows and start - windows[-1][1] <= gap:
+            windows[-1] = (windows[-1][0], max(windows[-1][1], end))
+        else:
+            windows.append((start, end))
+    return windows
+
+
+def update_listening_sessions(new_plays: List[Tuple[datetime, int]]) -> None:
+    """
+    Updates the listening sessions after new plays, as (played_at, ms_played),
+    were added.
+
+    Only sessions close enough to the new plays to be affected are deleted,
+    and the plays they cover are split into sessions again. This extends,
+    merges or creates sessions without looking at the rest of the history.
+    New plays far apart from each other, like retried plays from years ago
+    next to today's, are updated separately.
+    """
+    if not new_plays:
+        return
+
+    # Build everything once if sessions were never computed
+    if get_table_count("listening_sessions") == 0:
+        rebuild_listening_sessions()
+        return
+
+    for new_start, new_end in _cluster_plays(new_plays):
+        _update_window(new_start, new_end)
+
+
+def _update_window(new_start: datetime, new_end: datetime) -> None:
+    # Any session within the gap of the new plays could be extended or merged
+    affected = get_listening_sessions_between(
+        new_start - SESSION_GAP, new_end + SESSION_GAP
+    )
+    start = min([new_start] + [s["started_at"] for s in affected])
+    end = max([new_end] + [s["ended_at"] for s in affected])
+
+    sessions = split_sessions(get_plays_between(start, end))
+
+    # Committed together with the insert
+    delete_listening_sessions(start, end, commit=False)
+    insert_listening_sessions(sessions)
+    logger.debug(
+        f"Replaced {len(affected)} listening sessions with {len(sessions)} between {start} and {end}"
+    )
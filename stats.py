@@ -0,0 +1,188 @@
+import json
+import inspect
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from functools import wraps
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from typing import List, Dict, Any
+from urllib.parse import urlparse, parse_qs
+from logger import logger
+from models import (
+    get_top_tracks,
+    get_top_artists,
+    get_top_genres,
+    get_plays_per_day,
+    get_recent_plays,
+    get_streaming_history_version,
+)
+
+# Results are kept for CACHE_TTL seconds, or until new plays are added.
+# Only the CACHE_SIZE most recently used results are kept.
+# Results are keyed on the streaming history version, so plays added by
+# another process, e.g. a cron import while --serve is running, are seen
+# as well. The version is read at most every VERSION_CHECK_INTERVAL seconds.
+CACHE_TTL = 300
+CACHE_SIZE = 128
+VERSION_CHECK_INTERVAL = 10
+
+STATS_PORT = 8000
+
+_cache = OrderedDict()
+_version = None
+_version_checked_at = 0.0
+
+
+def invalidate_cache() -> None:
+    """
+    Drops all cached results. Called whenever new plays are added by this
+    process.
+    """
+    global _version
+    _cache.clear()
+    _version = None
+
+
+def _get_version(now: float) -> int:
+    global _version, _version_checked_at
+    if _version is None or now - _version_checked_at >= VERSION_CHECK_INTERVAL:
+        _version = get_streaming_history_version()
+        _version_checked_at = now
+    return _version
+
+
+def cached(func):
+    """
+    Caches the result of a stats function by its arguments.
+    """
+
+    signature = inspect.signature(func)
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        # Defaults are applied so f() and f(30) share the same entry
+        bound = signature.bind(*args, **kwargs)
+        bound.apply_defaults()
+        now = time.monotonic()
+        key = (func.__name__, bound.args, _get_version(now))
+
+        if key in _cache:
+            expires_at, result = _cache[key]
+            if expires_at > now:
+                _cache.move_to_end(key)
+                return result
+            del _cache[key]
+
+        result = func(*bound.args)
+        _cache[key] = (now + CACHE_TTL, result)
+        if len(_cache) > CACHE_SIZE:
+            _cache.popitem(last=False)
+        return result
+
+    return wrapper
+
+
+def _since(days: int) -> datetime:
+    # played_at is stored as naive UTC
+    return datetime.now(timezone.utc).replace(tzinfo=None) - timedelta(days=days)
+
+
+@cached
+def top_tracks(days: int = 30, limit: int = 10) -> List[Dict[str, Any]]:
+    """
+    Most played tracks in the last days.
+    """
+    return get_top_tracks(_since(days), limit)
+
+
+@cached
+def top_artists(days: int = 30, limit: int = 10) -> List[Dict[str, Any]]:
+    """
+    Most played artists in the last days.
+    """
+    return get_top_artists(_since(days), limit)
+
+
+@cached
+def top_genres(days: int = 30, limit: int = 10) -> List[Dict[str, Any]]:
+    """
+    Most played genres in the last days.
+    """
+    return get_top_genres(_since(days), limit)
+
+
+@cached
+def plays_per_day(days: int = 30) -> List[Dict[str, Any]]:
+    """
+    Plays and time played per day in the last days.
+    """
+    return get_plays_per_day(_since(days))
+
+
+@cached
+def recent_plays(limit: int = 20) -> List[Dict[str, Any]]:
+    """
+    Latest plays, most recent first.
+    """
+    return get_recent_plays(limit)
+
+
+# Path -> (stats function, accepted query parameters)
+ENDPOINTS = {
+    "/top-tracks": (top_tracks, ("days", "limit")),
+    "/top-artists": (top_artists, ("days", "limit")),
+    "/top-genres": (top_genres, ("days", "limit")),
+    "/plays-per-day": (plays_per_day, ("days",)),
+    "/recent-plays": (recent_plays, ("limit",)),
+}
+
+
+class StatsHandler(BaseHTTPRequestHandler):
+    """
+    Serves the stats functions as JSON, e.g. GET /top-tracks?days=7&limit=5
+    """
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path not in ENDPOINTS:
+            self.send_json(404, {"error": f"Unknown endpoint {url.path}"})
+            return
+
+        func, accepted = ENDPOINTS[url.path]
+        query = parse_qs(url.query)
+        try:
+            kwargs = {name: int(query[name][0]) for name in accepted if name in query}
+        except ValueError:
+            self.send_json(400, {"error": "Parameters must be integers"})
+            return
+
+        try:
+            self.send_json(200, func(**kwargs))
+        except Exception as e:
+            logger.error(f"Failed to get stats for {self.path}: {e}")
+            self.send_json(500, {"error": "Failed to get stats"})
+
+    def send_json(self, status: int, data: Any):
+        body = json.dumps(data, default=str).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(f"{self.address_string()} {format % args}")
+
+
+def serve_stats(port: int = STATS_PORT) -> None:
+    """
+    Serves the stats on localhost until interrupted.
+    """
+    server = HTTPServer(("127.0.0.1", port), StatsHandler)
+    logger.info(f"Serving stats on http://127.0.0.1:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()